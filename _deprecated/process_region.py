@@ -1,31 +1,267 @@
 #!/usr/bin/env python3
 """
-AWS Batch job script for processing a single OSM region to Parquet.
+AWS Batch job script for processing OSM regions to Parquet.
 
 Environment variables:
   - REGION_PATH: Geofabrik region path (e.g., "north-america/us/utah")
-  - S3_BUCKET: Output S3 bucket name
+  - REGION_PATHS: Optional comma-separated list of region paths to process in
+    one job (takes precedence over REGION_PATH)
+  - S3_BUCKET: Output S3 bucket name; Geofabrik downloads are also cached
+    under cache/<region>/<etag>.osm.pbf
+  - DUCKDB_THREADS: Optional DuckDB thread count (defaults to the CPUs this
+    process may run on, capped by the cgroup CPU quota)
+  - DUCKDB_EXTENSION_DIRECTORY: Optional directory of pre-installed DuckDB
+    extensions (spatial, httpfs)
+  - TMPDIR: Optional work directory for PBF intermediates (defaults to /dev/shm
+    when it has room, e.g. Batch linuxParameters.sharedMemorySize); DuckDB
+    always spills to disk
 """
 
+import math
 import os
+import shutil
 import subprocess
 import sys
 import tempfile
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import boto3
 import duckdb
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+# Region PBFs are hundreds of MB to GBs: move the S3 cache copies in parallel
+CACHE_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024**2,
+    multipart_chunksize=32 * 1024**2,
+    max_concurrency=16,
+    use_threads=True,
+)
+
+
+# POI classification rules as (class, tag key, tag values), in priority order:
+# a feature gets the class of the first rule matching any of its tags.
+# A value of None matches any value of that key.
+POI_CLASS_RULES: list[tuple[str, str, tuple[str, ...] | None]] = [
+    ("restaurant", "amenity", ("restaurant", "food_court", "diner", "bbq")),
+    ("cafe_bakery", "amenity", ("cafe", "coffee_shop", "tea")),
+    ("bar_pub", "amenity", ("bar", "pub", "biergarten")),
+    ("fast_food", "amenity", ("fast_food", "food_truck", "ice_cream", "street_vendor")),
+    ("ice_cream", "shop", ("ice_cream", "dessert", "frozen_yogurt")),
+    ("grocery", "shop", ("supermarket", "convenience", "grocery", "marketplace")),
+    ("grocery", "amenity", ("marketplace",)),
+    (
+        "specialty_food",
+        "shop",
+        (
+            "bakery", "butcher", "cheese", "confectionery", "chocolate", "deli",
+            "fishmonger", "frozen_food", "greengrocer", "health_food", "organic",
+            "pastry", "tea", "coffee",
+        ),
+    ),
+    (
+        "retail",
+        "shop",
+        (
+            "mall", "department_store", "car", "clothes", "fashion", "shoes",
+            "electronics", "computer", "hardware", "doityourself", "furniture",
+            "jewelry", "toys", "books", "gift", "cosmetics",
+        ),
+    ),
+    (
+        "personal_services",
+        "amenity",
+        (
+            "spa", "sauna", "hairdresser", "beauty_salon", "laundry", "dry_cleaning",
+        ),
+    ),
+    ("personal_services", "shop", ("hairdresser", "beauty", "massage")),
+    ("professional_services", "amenity", ("coworking_space", "conference_centre")),
+    (
+        "professional_services",
+        "office",
+        (
+            "company", "lawyer", "architect", "estate_agent", "accountant",
+        ),
+    ),
+    ("finance", "amenity", ("bank", "atm", "bureau_de_change", "money_transfer")),
+    (
+        "lodging",
+        "tourism",
+        (
+            "hotel", "guest_house", "hostel", "motel", "apartment", "chalet",
+            "alpine_hut", "camp_site", "caravan_site",
+        ),
+    ),
+    ("transport", "amenity", ("bus_station", "ferry_terminal")),
+    ("transport", "railway", ("station", "halt", "stop", "tram_stop")),
+    ("transport", "public_transport", ("station",)),
+    ("transport", "aeroway", ("aerodrome", "terminal")),
+    (
+        "auto_services",
+        "amenity",
+        (
+            "fuel", "charging_station", "car_wash", "car_rental", "car_repair",
+        ),
+    ),
+    ("auto_services", "shop", ("car_repair", "tyres")),
+    ("parking", "amenity", ("parking", "bicycle_parking", "motorcycle_parking")),
+    (
+        "healthcare",
+        "amenity",
+        (
+            "hospital", "clinic", "doctors", "dentist", "pharmacy", "ambulance_station",
+        ),
+    ),
+    ("healthcare", "healthcare", None),
+    (
+        "education",
+        "amenity",
+        (
+            "school", "kindergarten", "college", "university", "music_school",
+            "language_school", "library",
+        ),
+    ),
+    (
+        "government",
+        "amenity",
+        (
+            "townhall", "courthouse", "police", "fire_station", "post_office",
+            "embassy",
+        ),
+    ),
+    ("government", "office", ("government",)),
+    (
+        "community",
+        "amenity",
+        (
+            "community_centre", "social_centre", "youth_centre", "social_facility",
+            "shelter",
+        ),
+    ),
+    (
+        "religious",
+        "amenity",
+        (
+            "place_of_worship", "church", "mosque", "temple", "synagogue",
+        ),
+    ),
+    ("culture", "tourism", ("museum", "gallery")),
+    ("culture", "amenity", ("arts_centre", "theatre", "concert_hall", "planetarium")),
+    (
+        "entertainment",
+        "amenity",
+        (
+            "cinema", "nightclub", "casino", "bowling_alley", "amusement_arcade",
+        ),
+    ),
+    ("entertainment", "leisure", ("bowling_alley", "escape_game")),
+    (
+        "sports_fitness",
+        "leisure",
+        (
+            "sports_centre", "fitness_centre", "gym", "swimming_pool", "stadium",
+            "pitch", "ice_rink", "golf_course",
+        ),
+    ),
+    (
+        "parks_outdoors",
+        "leisure",
+        (
+            "park", "garden", "nature_reserve", "playground", "dog_park",
+        ),
+    ),
+    ("parks_outdoors", "tourism", ("picnic_site", "viewpoint")),
+    ("parks_outdoors", "natural", ("beach",)),
+    ("landmark", "tourism", ("attraction", "information")),
+    ("landmark", "historic", ("monument", "memorial", "castle", "ruins")),
+    ("landmark", "man_made", ("lighthouse", "tower")),
+    ("animal_services", "amenity", ("veterinary", "animal_boarding", "animal_shelter")),
+    ("animal_services", "shop", ("pet",)),
+    ("retail", "shop", None),
+    ("misc", "amenity", None),
+    ("misc", "leisure", None),
+    ("misc", "tourism", None),
+]
+
+
+def geofabrik_etag(url: str) -> str | None:
+    """ETag of a Geofabrik file, reduced to characters safe for an S3 key."""
+    try:
+        request = urllib.request.Request(url, method="HEAD")
+        with urllib.request.urlopen(request, timeout=30) as response:
+            etag = response.headers.get("ETag")
+    except OSError as e:
+        print(f"HEAD {url} failed ({e}), not using the download cache")
+        return None
+    if not etag:
+        return None
+    return "".join(c for c in etag if c.isalnum() or c in "-_") or None
+
+
+def fetch_url(url: str, output_path: Path) -> None:
+    """Download a URL with parallel ranged aria2c, falling back to curl."""
+    print(f"Downloading {url}...")
+    try:
+        subprocess.run(
+            [
+                "aria2c",
+                "--max-connection-per-server=8",
+                "--split=8",
+                "--min-split-size=20M",
+                "--dir",
+                str(output_path.parent),
+                "--out",
+                output_path.name,
+                url,
+            ],
+            check=True,
+        )
+    except FileNotFoundError:
+        print("aria2c not found, falling back to curl...")
+        subprocess.run(["curl", "-L", "-f", "-o", str(output_path), url], check=True)
 
 
-def download_pbf(region_path: str, output_dir: Path) -> Path:
-    """Download PBF from Geofabrik."""
+def download_pbf(region_path: str, output_dir: Path, bucket: str) -> Path:
+    """Download PBF from Geofabrik, through an S3 cache keyed by its ETag."""
     region_slug = region_path.replace("/", "_")
     output_path = output_dir / f"{region_slug}-latest.osm.pbf"
     url = f"https://download.geofabrik.de/{region_path}-latest.osm.pbf"
 
-    print(f"Downloading {url}...")
-    subprocess.run(["curl", "-L", "-f", "-o", str(output_path), url], check=True)
+    s3 = boto3.client("s3")
+    etag = geofabrik_etag(url)
+    cache_key = f"cache/{region_slug}/{etag}.osm.pbf" if etag else None
+
+    if cache_key:
+        try:
+            s3.head_object(Bucket=bucket, Key=cache_key)
+        except ClientError:
+            pass
+        else:
+            print(f"Fetching cached copy s3://{bucket}/{cache_key}...")
+            s3.download_file(
+                bucket, cache_key, str(output_path), Config=CACHE_TRANSFER_CONFIG
+            )
+            print(f"Downloaded {output_path.stat().st_size / 1024 / 1024:.1f} MB")
+            return output_path
+
+    fetch_url(url, output_path)
     print(f"Downloaded {output_path.stat().st_size / 1024 / 1024:.1f} MB")
+
+    if cache_key:
+        print(f"Caching to s3://{bucket}/{cache_key}...")
+        s3.upload_file(
+            str(output_path), bucket, cache_key, Config=CACHE_TRANSFER_CONFIG
+        )
+        # Geofabrik only serves the latest extract, so older ETags are dead
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"cache/{region_slug}/"):
+            for obj in page.get("Contents", []):
+                if obj["Key"] != cache_key:
+                    print(f"Removing stale cache s3://{bucket}/{obj['Key']}")
+                    s3.delete_object(Bucket=bucket, Key=obj["Key"])
     return output_path
 
 
@@ -75,182 +311,230 @@ def filter_pbf(input_pbf: Path, output_dir: Path) -> Path:
     return output_path
 
 
-def pbf_to_geojson(pbf_path: Path, output_dir: Path) -> Path:
-    """Convert PBF to newline-delimited GeoJSON using osmium export."""
-    output_path = output_dir / f"{pbf_path.stem}.ndjson"
+def container_cpu_count() -> int:
+    """CPUs this container may use: DUCKDB_THREADS, else affinity capped by cpu.max."""
+    override = os.environ.get("DUCKDB_THREADS")
+    if override:
+        return max(1, int(override))
+
+    cpus = len(os.sched_getaffinity(0))
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def configure_duckdb_resources(
+    conn: duckdb.DuckDBPyConnection, temp_dir: Path, memory_fraction: float = 0.7
+) -> None:
+    """Size DuckDB to the container and spill into `temp_dir`."""
+    conn.execute(f"SET threads = {container_cpu_count()}")
+
+    # cgroup v2, then v1; v1 reports "no limit" as a huge number
+    for path in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            value = Path(path).read_text().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 2**60:
+            memory_mb = int(int(value) * memory_fraction) // 1024**2
+            conn.execute(f"SET memory_limit = '{memory_mb}MB'")
+            break
+
+    conn.execute(f"SET temp_directory = '{temp_dir}'")
+    # Explicit ORDER BY still holds; this only lets unordered stages run freely
+    conn.execute("SET preserve_insertion_order = false")
+    conn.execute("SET enable_progress_bar = false")
+
+
+def refresh_s3_secret(conn: duckdb.DuckDBPyConnection) -> None:
+    """(Re)create DuckDB's S3 secret from the credentials boto3 resolves now.
+
+    The secret holds a snapshot of the credentials, and instance or task role
+    credentials can expire minutes after they are read, so main refreshes it
+    before every region rather than once per connection.
+    """
+    session = boto3.Session()
+    creds = session.get_credentials().get_frozen_credentials()
+    # boto3 does not read AWS_REGION, which is what Batch jobs get, and
+    # httpfs does not follow S3's redirects to the bucket's region
+    region = os.environ.get("AWS_REGION") or session.region_name or "us-east-1"
+
+    secret_options = [
+        "TYPE s3",
+        f"KEY_ID '{creds.access_key}'",
+        f"SECRET '{creds.secret_key}'",
+        f"REGION '{region}'",
+    ]
+    if creds.token:
+        secret_options.append(f"SESSION_TOKEN '{creds.token}'")
+    conn.sql(f"CREATE OR REPLACE SECRET aws_s3 ({', '.join(secret_options)})")
+
+
+def configure_s3_access(conn: duckdb.DuckDBPyConnection) -> None:
+    """Give DuckDB's httpfs AWS credentials and tune its multipart uploads."""
+    conn.sql("INSTALL httpfs; LOAD httpfs;")
+    refresh_s3_secret(conn)
+
+    # httpfs derives its multipart part size as max_filesize / max_parts;
+    # 320GB / 10000 gives 32 MB parts, uploaded 16 at a time.
+    conn.execute("SET s3_uploader_max_filesize = '320GB'")
+    conn.execute("SET s3_uploader_max_parts_per_file = 10000")
+    conn.execute("SET s3_uploader_thread_limit = 16")
+
+
+def connect_duckdb(
+    spill_dir: Path, memory_fraction: float = 0.7
+) -> duckdb.DuckDBPyConnection:
+    """Open a DuckDB connection with extensions, S3 access and POI rules loaded."""
+    conn = duckdb.connect()
 
-    print("Converting to GeoJSON...")
-    subprocess.run(
+    extension_directory = os.environ.get("DUCKDB_EXTENSION_DIRECTORY")
+    if extension_directory:
+        conn.execute(f"SET extension_directory='{extension_directory}'")
+
+    configure_duckdb_resources(conn, spill_dir, memory_fraction)
+    conn.sql("LOAD spatial;")
+    configure_s3_access(conn)
+
+    conn.execute(
+        "CREATE TEMP TABLE poi_rules "
+        "(tag_key VARCHAR, tag_value VARCHAR, priority INTEGER, class VARCHAR)"
+    )
+    conn.executemany(
+        "INSERT INTO poi_rules VALUES (?, ?, ?, ?)",
         [
-            "osmium",
-            "export",
-            str(pbf_path),
-            "-o",
-            str(output_path),
-            "-f",
-            "geojsonseq",
-            "-x",
-            "print_record_separator=false",
-            "-u",
-            "type_id",
-            "--geometry-types=point,polygon",
+            (key, value, priority, cls)
+            for priority, (cls, key, values) in enumerate(POI_CLASS_RULES)
+            for value in (values or (None,))
         ],
-        check=True,
     )
+    return conn
 
-    print(f"Converted to {output_path.stat().st_size / 1024 / 1024:.1f} MB")
-    return output_path
 
+def process_pbf_to_parquet(
+    conn: duckdb.DuckDBPyConnection, pbf_path: Path, region_name: str, bucket: str
+) -> str | None:
+    """Process filtered PBF to Parquet in S3 using DuckDB with spatial extension."""
+    output_uri = f"s3://{bucket}/parquet/{region_name}.parquet"
 
-def process_geojson_to_parquet(
-    geojson_path: Path, region_name: str, output_dir: Path
-) -> Path:
-    """Process GeoJSON to Parquet using DuckDB with spatial extension."""
-    output_path = output_dir / f"{region_name}.parquet"
+    print("Processing PBF to Parquet with DuckDB...")
 
-    print("Processing GeoJSON to Parquet with DuckDB...")
-
-    conn = duckdb.connect()
-    conn.sql("LOAD spatial;")
-
-    # Debug: check record count
-    count = conn.sql(f"""
-        SELECT COUNT(*) FROM read_json('{geojson_path}',
-            columns={{id: 'VARCHAR', type: 'VARCHAR', geometry: 'JSON', properties: 'JSON'}},
-            maximum_object_size=10485760
-        )
-    """).fetchone()[0]
-    print(f"  Total records in file: {count:,}")
-
-    # SQL query with POI classification and centroid computation
+    # SQL query with POI classification and centroid computation. The result
+    # is kept in memory so the stats below don't read the written Parquet.
     query = f"""
-    COPY (
-        WITH raw_features AS (
+    CREATE TEMP TABLE final_out AS (
+        WITH osm AS MATERIALIZED (
+            SELECT kind, id, tags, refs, lat, lon
+            FROM ST_ReadOSM('{pbf_path}')
+            WHERE kind IN ('node', 'way')
+        ),
+        -- Named closed ways are areas; rebuild their rings from node
+        -- coordinates. Open and unnamed ways are not POIs.
+        way_refs AS (
             SELECT
-                id as osm_id,
-                properties->>'@type' as osm_type,
-                properties->>'name' as name,
-                properties->>'amenity' as amenity,
-                properties->>'shop' as shop,
-                properties->>'leisure' as leisure,
-                properties->>'tourism' as tourism,
-                properties->>'office' as office,
-                properties->>'healthcare' as healthcare,
-                properties->>'railway' as railway,
-                properties->>'aeroway' as aeroway,
-                properties->>'historic' as historic,
-                properties->>'man_made' as man_made,
-                properties->>'natural' as "natural",
-                properties->>'public_transport' as public_transport,
-                properties->>'cuisine' as cuisine,
-                properties->>'opening_hours' as opening_hours,
-                properties->>'phone' as phone,
-                properties->>'website' as website,
-                properties->>'brand' as brand,
-                properties->>'operator' as "operator",
-                ST_Centroid(ST_GeomFromGeoJSON(geometry)) as centroid
-            FROM read_json('{geojson_path}',
-                columns={{id: 'VARCHAR', type: 'VARCHAR', geometry: 'JSON', properties: 'JSON'}},
-                maximum_object_size=10485760
-            )
-            WHERE properties->>'name' IS NOT NULL
-              AND geometry IS NOT NULL
+                id,
+                unnest(refs) as ref,
+                generate_subscripts(refs, 1) as idx,
+                len(refs) as ref_count
+            FROM osm
+            WHERE kind = 'way'
+              AND tags['name'] IS NOT NULL
+              AND len(refs) >= 4
+              AND refs[1] = refs[-1]
         ),
-        classified AS (
+        way_polygons AS (
             SELECT
-                *,
-                CASE
-                    -- Restaurant
-                    WHEN amenity IN ('restaurant', 'food_court', 'diner', 'bbq') THEN 'restaurant'
-                    -- Cafe/Bakery
-                    WHEN amenity IN ('cafe', 'coffee_shop', 'tea') THEN 'cafe_bakery'
-                    -- Bar/Pub
-                    WHEN amenity IN ('bar', 'pub', 'biergarten') THEN 'bar_pub'
-                    -- Fast Food
-                    WHEN amenity IN ('fast_food', 'food_truck', 'ice_cream', 'street_vendor') THEN 'fast_food'
-                    -- Ice Cream (shop takes precedence after amenity ice_cream caught above)
-                    WHEN shop IN ('ice_cream', 'dessert', 'frozen_yogurt') THEN 'ice_cream'
-                    -- Grocery
-                    WHEN shop IN ('supermarket', 'convenience', 'grocery', 'marketplace') THEN 'grocery'
-                    WHEN amenity = 'marketplace' THEN 'grocery'
-                    -- Specialty Food
-                    WHEN shop IN ('bakery', 'butcher', 'cheese', 'confectionery', 'chocolate',
-                                  'deli', 'fishmonger', 'frozen_food', 'greengrocer',
-                                  'health_food', 'organic', 'pastry', 'tea', 'coffee') THEN 'specialty_food'
-                    -- Retail
-                    WHEN shop IN ('mall', 'department_store', 'car', 'clothes', 'fashion',
-                                  'shoes', 'electronics', 'computer', 'hardware', 'doityourself',
-                                  'furniture', 'jewelry', 'toys', 'books', 'gift', 'cosmetics') THEN 'retail'
-                    -- Personal Services
-                    WHEN amenity IN ('spa', 'sauna', 'hairdresser', 'beauty_salon', 'laundry', 'dry_cleaning') THEN 'personal_services'
-                    WHEN shop IN ('hairdresser', 'beauty', 'massage') THEN 'personal_services'
-                    -- Professional Services
-                    WHEN amenity IN ('coworking_space', 'conference_centre') THEN 'professional_services'
-                    WHEN office IN ('company', 'lawyer', 'architect', 'estate_agent', 'accountant') THEN 'professional_services'
-                    -- Finance
-                    WHEN amenity IN ('bank', 'atm', 'bureau_de_change', 'money_transfer') THEN 'finance'
-                    -- Lodging
-                    WHEN tourism IN ('hotel', 'guest_house', 'hostel', 'motel', 'apartment',
-                                     'chalet', 'alpine_hut', 'camp_site', 'caravan_site') THEN 'lodging'
-                    -- Transport
-                    WHEN amenity IN ('bus_station', 'ferry_terminal') THEN 'transport'
-                    WHEN railway IN ('station', 'halt', 'stop', 'tram_stop') THEN 'transport'
-                    WHEN public_transport = 'station' THEN 'transport'
-                    WHEN aeroway IN ('aerodrome', 'terminal') THEN 'transport'
-                    -- Auto Services
-                    WHEN amenity IN ('fuel', 'charging_station', 'car_wash', 'car_rental', 'car_repair') THEN 'auto_services'
-                    WHEN shop IN ('car_repair', 'tyres') THEN 'auto_services'
-                    -- Parking
-                    WHEN amenity IN ('parking', 'bicycle_parking', 'motorcycle_parking') THEN 'parking'
-                    -- Healthcare
-                    WHEN amenity IN ('hospital', 'clinic', 'doctors', 'dentist', 'pharmacy', 'ambulance_station') THEN 'healthcare'
-                    WHEN healthcare IS NOT NULL THEN 'healthcare'
-                    -- Education
-                    WHEN amenity IN ('school', 'kindergarten', 'college', 'university',
-                                     'music_school', 'language_school', 'library') THEN 'education'
-                    -- Government
-                    WHEN amenity IN ('townhall', 'courthouse', 'police', 'fire_station',
-                                     'post_office', 'embassy') THEN 'government'
-                    WHEN office = 'government' THEN 'government'
-                    -- Community
-                    WHEN amenity IN ('community_centre', 'social_centre', 'youth_centre',
-                                     'social_facility', 'shelter') THEN 'community'
-                    -- Religious
-                    WHEN amenity IN ('place_of_worship', 'church', 'mosque', 'temple', 'synagogue') THEN 'religious'
-                    -- Culture
-                    WHEN tourism IN ('museum', 'gallery') THEN 'culture'
-                    WHEN amenity IN ('arts_centre', 'theatre', 'concert_hall', 'planetarium') THEN 'culture'
-                    -- Entertainment
-                    WHEN amenity IN ('cinema', 'nightclub', 'casino', 'bowling_alley', 'amusement_arcade') THEN 'entertainment'
-                    WHEN leisure IN ('bowling_alley', 'escape_game') THEN 'entertainment'
-                    -- Sports/Fitness
-                    WHEN leisure IN ('sports_centre', 'fitness_centre', 'gym', 'swimming_pool',
-                                     'stadium', 'pitch', 'ice_rink', 'golf_course') THEN 'sports_fitness'
-                    -- Parks/Outdoors
-                    WHEN leisure IN ('park', 'garden', 'nature_reserve', 'playground', 'dog_park') THEN 'parks_outdoors'
-                    WHEN tourism IN ('picnic_site', 'viewpoint') THEN 'parks_outdoors'
-                    WHEN "natural" = 'beach' THEN 'parks_outdoors'
-                    -- Landmark
-                    WHEN tourism IN ('attraction', 'information') THEN 'landmark'
-                    WHEN historic IN ('monument', 'memorial', 'castle', 'ruins') THEN 'landmark'
-                    WHEN man_made IN ('lighthouse', 'tower') THEN 'landmark'
-                    -- Animal Services
-                    WHEN amenity IN ('veterinary', 'animal_boarding', 'animal_shelter') THEN 'animal_services'
-                    WHEN shop = 'pet' THEN 'animal_services'
-                    -- Fallbacks
-                    WHEN shop IS NOT NULL THEN 'retail'
-                    WHEN amenity IS NOT NULL OR leisure IS NOT NULL OR tourism IS NOT NULL THEN 'misc'
-                    ELSE NULL
-                END as class
+                r.id,
+                ST_MakePolygon(ST_MakeLine(
+                    list(ST_Point(n.lon, n.lat) ORDER BY r.idx)
+                )) as geometry
+            FROM way_refs r
+            JOIN osm n ON n.kind = 'node' AND n.id = r.ref
+            GROUP BY r.id
+            HAVING count(*) = any_value(r.ref_count)
+        ),
+        features AS (
+            SELECT
+                'n' || id as osm_id,
+                'node' as osm_type,
+                tags,
+                ST_Point(lon, lat) as geometry
+            FROM osm
+            WHERE kind = 'node'
+              AND tags['name'] IS NOT NULL
+            UNION ALL
+            SELECT
+                'w' || w.id as osm_id,
+                'way' as osm_type,
+                w.tags,
+                p.geometry
+            FROM osm w
+            JOIN way_polygons p ON w.kind = 'way' AND w.id = p.id
+        ),
+        raw_features AS MATERIALIZED (
+            SELECT
+                osm_id,
+                osm_type,
+                tags,
+                tags['name'] as name,
+                tags['amenity'] as amenity,
+                tags['shop'] as shop,
+                tags['leisure'] as leisure,
+                tags['tourism'] as tourism,
+                tags['cuisine'] as cuisine,
+                tags['opening_hours'] as opening_hours,
+                tags['phone'] as phone,
+                tags['website'] as website,
+                tags['brand'] as brand,
+                tags['operator'] as "operator",
+                ST_Centroid(geometry) as centroid
+            FROM features
+        ),
+        -- One row per tag, so classification is a hash join against
+        -- poi_rules instead of a CASE evaluated rule by rule.
+        feature_tags AS (
+            SELECT
+                osm_id,
+                unnest(map_keys(tags)) as tag_key,
+                unnest(map_values(tags)) as tag_value
             FROM raw_features
+        ),
+        tag_matches AS (
+            SELECT t.osm_id, r.priority, r.class
+            FROM feature_tags t
+            JOIN poi_rules r ON r.tag_key = t.tag_key AND r.tag_value = t.tag_value
+            UNION ALL
+            SELECT t.osm_id, r.priority, r.class
+            FROM feature_tags t
+            JOIN poi_rules r ON r.tag_key = t.tag_key AND r.tag_value IS NULL
+        ),
+        classified AS (
+            SELECT
+                f.*,
+                ST_X(f.centroid)::DOUBLE as lon,
+                ST_Y(f.centroid)::DOUBLE as lat,
+                m.class
+            FROM raw_features f
+            JOIN (
+                SELECT osm_id, arg_min(class, priority) as class
+                FROM tag_matches
+                GROUP BY osm_id
+            ) m USING (osm_id)
         )
         SELECT
             osm_id,
             osm_type,
             name,
             class,
-            ST_X(centroid)::DOUBLE as lon,
-            ST_Y(centroid)::DOUBLE as lat,
+            lon,
+            lat,
             '{region_name}' as state,
             amenity,
             shop,
@@ -262,30 +546,26 @@ def process_geojson_to_parquet(
             website,
             brand,
             "operator",
-            FLOOR(ST_X(centroid))::INTEGER as lon_bucket,
-            FLOOR(ST_Y(centroid))::INTEGER as lat_bucket
+            FLOOR(lon)::INTEGER as lon_bucket,
+            FLOOR(lat)::INTEGER as lat_bucket
         FROM classified
-        WHERE class IS NOT NULL
-    ) TO '{output_path}' (FORMAT PARQUET, COMPRESSION SNAPPY)
+    )
     """
 
     conn.sql(query)
 
     # Get stats
-    stats = conn.sql(f"""
-        SELECT
-            COUNT(*) as total,
-            COUNT(DISTINCT class) as classes
-        FROM read_parquet('{output_path}')
-    """).fetchone()
+    stats = conn.sql(
+        "SELECT COUNT(*) as total, COUNT(DISTINCT class) as classes FROM final_out"
+    ).fetchone()
 
     print(f"Total POIs: {stats[0]:,}")
     print(f"Unique classes: {stats[1]}")
 
     # Show class breakdown
-    class_counts = conn.sql(f"""
+    class_counts = conn.sql("""
         SELECT class, COUNT(*) as cnt
-        FROM read_parquet('{output_path}')
+        FROM final_out
         GROUP BY class
         ORDER BY cnt DESC
         LIMIT 10
@@ -295,33 +575,66 @@ def process_geojson_to_parquet(
     for cls, cnt in class_counts:
         print(f"  {cls}: {cnt:,}")
 
-    file_size = output_path.stat().st_size / 1024 / 1024
-    print(f"Wrote {output_path} ({file_size:.1f} MB)")
-
-    conn.close()
-
     if stats[0] == 0:
         print("WARNING: No POIs found!")
+        conn.sql("DROP TABLE final_out")
         return None
 
-    return output_path
+    # httpfs streams the file to S3 as a multipart upload while it is written
+    print(f"Writing {output_uri}...")
+    conn.sql(f"""
+        COPY (
+            SELECT * FROM final_out
+            -- Cluster rows spatially so row-group min/max stats on lon/lat
+            -- let bbox queries skip most of the file.
+            ORDER BY lon_bucket, lat_bucket, FLOOR(lon * 10), FLOOR(lat * 10)
+        ) TO '{output_uri}' (
+            FORMAT PARQUET,
+            COMPRESSION ZSTD,
+            COMPRESSION_LEVEL 3,
+            ROW_GROUP_SIZE 50000
+        )
+    """)
 
+    conn.sql("DROP TABLE final_out")
+    return output_uri
 
-def upload_to_s3(local_path: Path, bucket: str, region_name: str) -> str:
-    """Upload Parquet file to S3."""
-    s3_key = f"parquet/{region_name}.parquet"
 
-    print(f"Uploading to s3://{bucket}/{s3_key}...")
-    s3 = boto3.client("s3")
-    s3.upload_file(str(local_path), bucket, s3_key)
+def prepare_region(region_path: str, work_dir: Path, bucket: str) -> Path:
+    """Download and filter a region into its own directory under work_dir."""
+    region_dir = work_dir / region_path.replace("/", "_")
+    region_dir.mkdir()
+
+    pbf_path = download_pbf(region_path, region_dir, bucket)
+    filtered_pbf = filter_pbf(pbf_path, region_dir)
+    pbf_path.unlink()
+    return filtered_pbf
 
-    return f"s3://{bucket}/{s3_key}"
+
+def work_dir_root() -> str | None:
+    """Where to put intermediates: TMPDIR, else tmpfs if it's sized for it."""
+    if os.environ.get("TMPDIR"):
+        return None  # tempfile already honours TMPDIR
+    # Docker's default /dev/shm is 64 MB; only use it when it was enlarged
+    shm = Path("/dev/shm")
+    if shm.is_dir() and shutil.disk_usage(shm).free >= 8 * 1024**3:
+        return str(shm)
+    return None
 
 
 def main():
-    region_path = os.environ.get("REGION_PATH")
-    if not region_path:
-        print("ERROR: REGION_PATH environment variable required")
+    # Listing a region twice would collide on its work directory
+    region_paths = list(
+        dict.fromkeys(
+            path.strip()
+            for path in (
+                os.environ.get("REGION_PATHS") or os.environ.get("REGION_PATH") or ""
+            ).split(",")
+            if path.strip()
+        )
+    )
+    if not region_paths:
+        print("ERROR: REGION_PATH or REGION_PATHS environment variable required")
         sys.exit(1)
 
     s3_bucket = os.environ.get("S3_BUCKET")
@@ -329,27 +642,63 @@ def main():
         print("ERROR: S3_BUCKET environment variable required")
         sys.exit(1)
 
-    # Derive region name
-    region_name = region_path.split("/")[-1]
-
-    print(f"Processing region: {region_path} -> {region_name}")
+    print(f"Processing regions: {', '.join(region_paths)}")
     print(f"Output bucket: {s3_bucket}")
 
-    with tempfile.TemporaryDirectory() as tmpdir:
+    # tmpfs pages are charged to the container's memory cgroup, so DuckDB
+    # never spills there, and leaves room for the PBFs when they live on it
+    pbf_root = work_dir_root()
+    on_tmpfs = pbf_root == "/dev/shm"
+    outputs = []
+    with (
+        tempfile.TemporaryDirectory(dir=pbf_root) as tmpdir,
+        tempfile.TemporaryDirectory() as spill_dir,
+    ):
         work_dir = Path(tmpdir)
-
-        pbf_path = download_pbf(region_path, work_dir)
-        filtered_pbf = filter_pbf(pbf_path, work_dir)
-        geojson_path = pbf_to_geojson(filtered_pbf, work_dir)
-        parquet_path = process_geojson_to_parquet(geojson_path, region_name, work_dir)
-
-        if parquet_path is None:
-            print("WARNING: No POIs found, nothing to upload")
-            sys.exit(0)
-
-        s3_uri = upload_to_s3(parquet_path, s3_bucket, region_name)
-
-        print(f"\nDone! Output: {s3_uri}")
+        conn = connect_duckdb(Path(spill_dir), 0.4 if on_tmpfs else 0.7)
+
+        # osmium and the download are mostly single-threaded I/O, so the next
+        # region is fetched and filtered while DuckDB works on the current one.
+        # On tmpfs that second region would sit in RAM next to DuckDB, so
+        # there it is only prepared once the current one is done.
+        prefetch = ThreadPoolExecutor(max_workers=1)
+        try:
+            pending = prefetch.submit(
+                prepare_region, region_paths[0], work_dir, s3_bucket
+            )
+            for i, region_path in enumerate(region_paths):
+                filtered_pbf = pending.result()
+                next_path = region_paths[i + 1] if i + 1 < len(region_paths) else None
+                if next_path and not on_tmpfs:
+                    pending = prefetch.submit(
+                        prepare_region, next_path, work_dir, s3_bucket
+                    )
+
+                # Derive region name
+                region_name = region_path.split("/")[-1]
+                print(f"\nProcessing region: {region_path} -> {region_name}")
+
+                refresh_s3_secret(conn)
+                s3_uri = process_pbf_to_parquet(
+                    conn, filtered_pbf, region_name, s3_bucket
+                )
+                filtered_pbf.unlink()
+                if s3_uri is not None:
+                    outputs.append(s3_uri)
+
+                if next_path and on_tmpfs:
+                    pending = prefetch.submit(
+                        prepare_region, next_path, work_dir, s3_bucket
+                    )
+        finally:
+            # Don't hold an error back until an in-flight prefetch finishes
+            prefetch.shutdown(wait=False, cancel_futures=True)
+
+        conn.close()
+
+    print(f"\nDone! {len(outputs)} of {len(region_paths)} regions written:")
+    for s3_uri in outputs:
+        print(f"  {s3_uri}")
 
 
 if __name__ == "__main__":
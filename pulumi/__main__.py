@@ -151,6 +151,7 @@ sfn_role = create_sfn_role(
     job_definition_arns={
         "download": job_definitions["download"].arn,
         "sharder": job_definitions["sharder"].arn,
+        "partitioner": job_definitions["partitioner"].arn,
         "processor": job_definitions["processor"].arn,
         "merger": job_definitions["merger"].arn,
         "tiles": job_definitions["tiles"].arn,
@@ -165,6 +166,7 @@ statemachine_definition = pulumi.Output.all(
     JobQueueArn=job_queue.arn,
     DownloadJobDefArn=job_definitions["download"].arn,
     SharderJobDefArn=job_definitions["sharder"].arn,
+    PartitionerJobDefArn=job_definitions["partitioner"].arn,
     ProcessorJobDefArn=job_definitions["processor"].arn,
     MergerJobDefArn=job_definitions["merger"].arn,
     TilesJobDefArn=job_definitions["tiles"].arn,
@@ -177,6 +179,7 @@ statemachine_definition = pulumi.Output.all(
             )
             .replace("${DownloadJobDefArn}", args["DownloadJobDefArn"])
             .replace("${SharderJobDefArn}", args["SharderJobDefArn"])
+            .replace("${PartitionerJobDefArn}", args["PartitionerJobDefArn"])
             .replace("${ProcessorJobDefArn}", args["ProcessorJobDefArn"])
             .replace("${MergerJobDefArn}", args["MergerJobDefArn"])
             .replace("${TilesJobDefArn}", args["TilesJobDefArn"])
@@ -79,12 +79,26 @@ def create_job_definition(
     vcpus: int,
     memory: int,
     environment_vars: dict[str, str] | None = None,
+    host_mounts: dict[str, str] | None = None,
 ) -> aws.batch.JobDefinition:
-    """Create a Batch job definition."""
+    """Create a Batch job definition.
+
+    `host_mounts` maps host paths to container paths, so containers on the
+    same instance can share data (e.g. the planet cache).
+    """
     env_list: list[dict[str, str]] = []
     if environment_vars:
         env_list = [{"name": k, "value": v} for k, v in environment_vars.items()]
 
+    volumes: list[dict] = []
+    mount_points: list[dict] = []
+    for i, (host_path, container_path) in enumerate((host_mounts or {}).items()):
+        volume_name = f"host-{i}"
+        volumes.append({"name": volume_name, "host": {"sourcePath": host_path}})
+        mount_points.append(
+            {"sourceVolume": volume_name, "containerPath": container_path}
+        )
+
     container_properties = pulumi.Output.all(
         image_uri, execution_role_arn, job_role_arn, bucket_name
     ).apply(
@@ -100,6 +114,8 @@ def create_job_definition(
                 "environment": env_list + [
                     {"name": "S3_BUCKET", "value": args[3]}
                 ],
+                "volumes": volumes,
+                "mountPoints": mount_points,
                 "logConfiguration": {
                     "logDriver": "awslogs",
                     "options": {
@@ -150,10 +166,11 @@ def create_all_job_definitions(
     job_definitions: dict[str, aws.batch.JobDefinition] = {}
 
     # Map job config names to image names
-    # download, processor, merger all use the shared "batch" image
+    # download, partitioner, processor, merger all use the shared "batch" image
     job_to_image = {
         "download": "batch",
         "sharder": "sharder",
+        "partitioner": "batch",
         "processor": "batch",
         "merger": "batch",
         "tiles": "tiles",
@@ -162,6 +179,7 @@ def create_all_job_definitions(
     # Map job names to STAGE env var values (for the batch image)
     job_to_stage = {
         "download": "download",
+        "partitioner": "partition",
         "processor": "process",
         "merger": "merge",
     }
@@ -189,6 +207,14 @@ def create_all_job_definitions(
         # Add STAGE for batch image jobs
         if job_name in job_to_stage:
             env_vars["STAGE"] = job_to_stage[job_name]
+            # Batch enforces vCPUs as CPU shares, so tell DuckDB explicitly
+            env_vars["DUCKDB_THREADS"] = str(config["vcpus"])
+
+        # Processor jobs on the same instance share one cached planet file
+        host_mounts = None
+        if job_name == "processor":
+            env_vars["PLANET_CACHE_DIR"] = "/var/cache/osm"
+            host_mounts = {"/var/cache/osm": "/var/cache/osm"}
 
         job_def = create_job_definition(
             job_name=job_name,
@@ -199,6 +225,7 @@ def create_all_job_definitions(
             vcpus=config["vcpus"],
             memory=config["memory"],
             environment_vars=env_vars,
+            host_mounts=host_mounts,
         )
         job_definitions[job_name] = job_def
 
@@ -61,6 +61,7 @@ instance_types = [
 job_configs = {
     "download": {"vcpus": 4, "memory": 8192},
     "sharder": {"vcpus": 8, "memory": 32768},
+    "partitioner": {"vcpus": 8, "memory": 32768},
     "processor": {"vcpus": 2, "memory": 4096},
     "merger": {"vcpus": 4, "memory": 16384},
     "tiles": {"vcpus": 4, "memory": 16384},
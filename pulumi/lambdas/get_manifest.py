@@ -3,11 +3,14 @@ Helper lambda to get the shards manifest from S3
 """
 
 import json
+import math
 import boto3
 import os
 
 s3 = boto3.client("s3")
 BUCKET_NAME = os.environ["DATA_BUCKET_NAME"]
+# Shards cut per partition array child (one pass over the planet each)
+EXTRACTS_PER_PASS = int(os.environ.get("EXTRACTS_PER_PASS", "500"))
 
 def handler(event, context):
     run_id = event.get("run_id")
@@ -33,7 +36,16 @@ def handler(event, context):
                     }
                 )
 
-        return {"status": "SUCCESS", "shards": shards}
+        # Batch array jobs need at least two children; a spare one finds no
+        # shards in its range and exits without reading the planet
+        partition_passes = max(2, math.ceil(len(shards) / EXTRACTS_PER_PASS))
+
+        return {
+            "status": "SUCCESS",
+            "shards": shards,
+            "extracts_per_pass": EXTRACTS_PER_PASS,
+            "partition_passes": partition_passes,
+        }
     except Exception as e:
         print(f"Error reading manifest from s3://{BUCKET_NAME}/{manifest_key}: {e}")
         raise e
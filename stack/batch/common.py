@@ -2,21 +2,64 @@
 Common utilities for OSM-H3 batch processing.
 """
 
+import functools
+import math
 import os
 import sys
 from pathlib import Path
 
 import boto3
 import duckdb
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 
 # ============================================================
 # S3 Helpers
 # ============================================================
 
+# Planet-sized objects: split into 64 MB parts moved in parallel (ranged GETs
+# on download, multipart upload on upload)
+PLANET_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=64 * 1024**2,
+    multipart_chunksize=64 * 1024**2,
+    max_concurrency=16,
+    use_threads=True,
+)
+
+# Stage outputs (tens to hundreds of MB): parallel multipart uploads
+OUTPUT_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024**2,
+    multipart_chunksize=16 * 1024**2,
+    max_concurrency=8,
+    use_threads=True,
+)
+
+# Server-side copies: a single CopyObject up to its 5 GB limit, parallel
+# UploadPartCopy above it
+COPY_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=5 * 1024**3,
+    multipart_chunksize=512 * 1024**2,
+    max_concurrency=16,
+    use_threads=True,
+)
+
+
+@functools.cache
 def get_s3_client():
-    """Get boto3 S3 client."""
-    return boto3.client("s3")
+    """Get the shared boto3 S3 client.
+
+    The pool is sized for the parallel transfers above, and adaptive retries
+    back off on S3 503 SlowDown instead of failing the stage.
+    """
+    return boto3.client(
+        "s3",
+        config=Config(
+            max_pool_connections=64,
+            retries={"max_attempts": 10, "mode": "adaptive"},
+            tcp_keepalive=True,
+        ),
+    )
 
 
 def get_s3_bucket() -> str:
@@ -47,6 +90,94 @@ def configure_duckdb_extensions(conn: duckdb.DuckDBPyConnection) -> None:
         conn.execute(f"SET extension_directory='{extension_directory}'")
 
 
+def container_cpu_count() -> int:
+    """Number of CPUs this container may use (DUCKDB_THREADS overrides).
+
+    AWS Batch on EC2 enforces vCPUs as CPU shares rather than a quota, so the
+    job definition passes its vCPU count through DUCKDB_THREADS.
+    """
+    override = os.environ.get("DUCKDB_THREADS")
+    if override:
+        return max(1, int(override))
+
+    cpus = os.process_cpu_count() or 1
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def container_memory_bytes() -> int | None:
+    """Memory limit of this container from cgroup v2 or v1, if any."""
+    for path in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            value = Path(path).read_text().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 2**60:
+            return int(value)
+    return None
+
+
+def configure_duckdb_resources(
+    conn: duckdb.DuckDBPyConnection,
+    memory_fraction: float = 0.7,
+    temp_dir: Path | None = None,
+) -> None:
+    """Size DuckDB threads and memory to the container rather than the host.
+
+    If temp_dir is given, larger-than-memory operators spill there instead of
+    next to the (in-memory) database.
+    """
+    threads = container_cpu_count()
+    conn.execute(f"SET threads = {threads}")
+
+    memory_limit = container_memory_bytes()
+    if memory_limit:
+        memory_mb = int(memory_limit * memory_fraction) // 1024**2
+        conn.execute(f"SET memory_limit = '{memory_mb}MB'")
+        print(f"DuckDB: {threads} threads, {memory_mb} MB memory limit")
+    else:
+        print(f"DuckDB: {threads} threads")
+
+    if temp_dir is not None:
+        conn.execute(f"SET temp_directory = '{temp_dir}'")
+
+    # Explicit ORDER BY still holds; this only lets unordered stages run freely
+    conn.execute("SET preserve_insertion_order = false")
+
+
+def configure_duckdb_s3(conn: duckdb.DuckDBPyConnection) -> None:
+    """Let DuckDB read s3:// paths with the credentials boto3 resolves.
+
+    The secret holds a snapshot of the credentials taken now; it does not
+    refresh, so use it for a stage's work and open a new connection after
+    the job role's credentials have rotated.
+    """
+    load_duckdb_extension(conn, "httpfs", "INSTALL httpfs")
+
+    session = boto3.Session()
+    creds = session.get_credentials().get_frozen_credentials()
+    # Batch job definitions set AWS_REGION, which boto3 does not read;
+    # httpfs does not follow S3's redirects to the bucket's region.
+    region = os.environ.get("AWS_REGION") or session.region_name or "us-east-1"
+    secret_options = [
+        "TYPE s3",
+        f"KEY_ID '{creds.access_key}'",
+        f"SECRET '{creds.secret_key}'",
+        f"REGION '{region}'",
+    ]
+    if creds.token:
+        secret_options.append(f"SESSION_TOKEN '{creds.token}'")
+    conn.execute(f"CREATE SECRET ({', '.join(secret_options)})")
+
+
 def load_duckdb_extension(
     conn: duckdb.DuckDBPyConnection, name: str, install_sql: str
 ) -> None:
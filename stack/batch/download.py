@@ -15,7 +15,7 @@ import subprocess
 import tempfile
 from pathlib import Path
 
-from common import get_s3_client, get_s3_bucket, require_env
+from common import PLANET_TRANSFER_CONFIG, get_s3_client, get_s3_bucket, require_env
 
 # Configuration
 RUN_ID = os.environ.get("RUN_ID")
@@ -76,7 +76,9 @@ def main() -> None:
         # Upload to S3
         print("Uploading to S3...")
         storage_key = f"{OUTPUT_PREFIX}/planet.osm.pbf"
-        s3.upload_file(str(planet_path), bucket, storage_key)
+        s3.upload_file(
+            str(planet_path), bucket, storage_key, Config=PLANET_TRANSFER_CONFIG
+        )
         print(f"Uploaded to s3://{bucket}/{storage_key}")
         print("Done!")
 
@@ -16,7 +16,15 @@ from pathlib import Path
 
 import duckdb
 
-from common import get_s3_client, get_s3_bucket, require_env
+from common import (
+    COPY_TRANSFER_CONFIG,
+    OUTPUT_TRANSFER_CONFIG,
+    configure_duckdb_resources,
+    configure_duckdb_s3,
+    get_s3_client,
+    get_s3_bucket,
+    require_env,
+)
 
 # Configuration
 RUN_ID = os.environ.get("RUN_ID")
@@ -42,8 +50,6 @@ def main() -> None:
 
     with tempfile.TemporaryDirectory() as tmpdir:
         work_dir = Path(tmpdir)
-        shards_dir = work_dir / "shards"
-        shards_dir.mkdir()
 
         # List all shard outputs
         prefix = f"{INPUT_PREFIX}/shards/"
@@ -63,25 +69,43 @@ def main() -> None:
             print("ERROR: No shard outputs found")
             sys.exit(1)
 
-        # Download all shard parquet files
-        print("Downloading shard outputs...")
-        for i, key in enumerate(parquet_keys):
-            shard_id = key.split("/")[-2]
-            local_path = shards_dir / f"{shard_id}.parquet"
-            s3.download_file(bucket, key, str(local_path))
-            if (i + 1) % 10 == 0:
-                print(f"  Downloaded {i + 1}/{len(parquet_keys)}")
-
-        # Merge with DuckDB
+        # Merge with DuckDB, reading the shards straight from S3: httpfs
+        # fetches them in parallel and nothing is staged on local disk
         print("Merging parquet files...")
         conn = duckdb.connect()
+        configure_duckdb_resources(conn, temp_dir=work_dir / "duckdb_tmp")
+        configure_duckdb_s3(conn)
+        shards = conn.read_parquet(
+            [f"s3://{bucket}/{key}" for key in parquet_keys],
+            filename=True,
+            union_by_name=True,
+        )
+        shards.create_view("shards")
+        # Shards written before shard_id moved out of the rows still carry
+        # the column; drop it so the derived one doesn't become shard_id_1
+        excluded = ", ".join(
+            c for c in ("filename", "shard_id") if c in shards.columns
+        )
 
         output_path = work_dir / "pois.parquet"
         conn.sql(
             f"""
             COPY (
-                SELECT * FROM read_parquet('{shards_dir}/*.parquet')
-            ) TO '{output_path}' (FORMAT PARQUET, COMPRESSION SNAPPY)
+                -- shard_id is recovered from the object key
+                -- (shards/{{shard_id}}/data.parquet) rather than stored per row.
+                SELECT
+                    * EXCLUDE ({excluded}),
+                    string_split(filename, '/')[-2] as shard_id
+                FROM shards
+                -- Clustering by class lets readers skip row groups when
+                -- filtering on it and compresses the dictionaries better
+                ORDER BY class, shard_id
+            ) TO '{output_path}' (
+                FORMAT PARQUET,
+                COMPRESSION ZSTD,
+                COMPRESSION_LEVEL 3,
+                ROW_GROUP_SIZE 100000
+            )
         """
         )
 
@@ -104,12 +128,19 @@ def main() -> None:
         # Upload final output
         final_key = f"{OUTPUT_PREFIX}/output/pois.parquet"
         print(f"Uploading to s3://{bucket}/{final_key}...")
-        s3.upload_file(str(output_path), bucket, final_key)
+        s3.upload_file(
+            str(output_path), bucket, final_key, Config=OUTPUT_TRANSFER_CONFIG
+        )
 
         # Also copy to the 'latest' location for the tiles job
         latest_key = "parquet/pois.parquet"
         print(f"Copying to s3://{bucket}/{latest_key}...")
-        s3.upload_file(str(output_path), bucket, latest_key)
+        s3.copy(
+            {"Bucket": bucket, "Key": final_key},
+            bucket,
+            latest_key,
+            Config=COPY_TRANSFER_CONFIG,
+        )
 
         conn.close()
         print("Done!")
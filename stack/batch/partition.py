@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Partition stage: Cut the planet into one PBF extract per shard.
+
+Reads the planet once per batch of shards with `osmium extract --config`, so
+process jobs download only their own extract instead of each re-reading the
+full planet. Run as a Batch array job, each child cuts one batch, so the
+passes over the planet run in parallel; run standalone, it cuts them all.
+
+Environment variables:
+  - RUN_ID: Unique identifier for this pipeline run
+  - INPUT_PREFIX: S3 prefix for input files (e.g., /run/<run_id>)
+  - OUTPUT_PREFIX: S3 prefix for output files (e.g., /run/<run_id>)
+  - S3_BUCKET: S3 bucket name
+  - EXTRACTS_PER_PASS: Shards cut per pass over the planet (default: 500)
+  - AWS_BATCH_JOB_ARRAY_INDEX: Set by Batch for array children; selects the
+    batch of shards (pass) this child cuts
+"""
+
+import json
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from common import (
+    OUTPUT_TRANSFER_CONFIG,
+    PLANET_TRANSFER_CONFIG,
+    get_s3_client,
+    get_s3_bucket,
+    get_tile_bbox,
+    require_env,
+)
+
+# Configuration
+RUN_ID = os.environ.get("RUN_ID")
+INPUT_PREFIX = os.environ.get("INPUT_PREFIX", "").lstrip("/")
+OUTPUT_PREFIX = os.environ.get("OUTPUT_PREFIX", "").lstrip("/")
+# osmium keeps per-extract state in memory; it recommends staying around 500
+EXTRACTS_PER_PASS = int(os.environ.get("EXTRACTS_PER_PASS", "500"))
+ARRAY_INDEX = os.environ.get("AWS_BATCH_JOB_ARRAY_INDEX")
+UPLOAD_WORKERS = 16
+
+
+def load_manifest(s3, bucket: str) -> list[dict]:
+    """Read the sharder manifest and return the shard properties."""
+    manifest_key = f"{INPUT_PREFIX}/shards/manifest.json"
+    print(f"Reading s3://{bucket}/{manifest_key}...")
+    response = s3.get_object(Bucket=bucket, Key=manifest_key)
+    manifest = json.loads(response["Body"].read())
+    return [feature["properties"] for feature in manifest["features"]]
+
+
+def extract_shards(planet_path: Path, shards: list[dict], output_dir: Path) -> None:
+    """Write one `{shard_id}.osm.pbf` per shard in a single pass over the planet."""
+    extracts = []
+    for shard in shards:
+        bbox = get_tile_bbox(int(shard["z"]), int(shard["x"]), int(shard["y"]))
+        extracts.append(
+            {
+                "output": f"{shard['shard_id']}.osm.pbf",
+                "bbox": [bbox["west"], bbox["south"], bbox["east"], bbox["north"]],
+            }
+        )
+
+    config_path = output_dir / "extracts.json"
+    config_path.write_text(json.dumps({"extracts": extracts}))
+
+    subprocess.run(
+        [
+            "osmium",
+            "extract",
+            "--config",
+            str(config_path),
+            "--directory",
+            str(output_dir),
+            "--strategy",
+            "smart",
+            "--overwrite",
+            str(planet_path),
+        ],
+        check=True,
+    )
+    config_path.unlink()
+
+
+def upload_extracts(s3, bucket: str, shards: list[dict], output_dir: Path) -> None:
+    """Upload and delete each shard extract so the next pass has disk to spare."""
+
+    def upload(shard: dict) -> None:
+        extract_path = output_dir / f"{shard['shard_id']}.osm.pbf"
+        storage_key = f"{OUTPUT_PREFIX}/extracts/{extract_path.name}"
+        s3.upload_file(
+            str(extract_path), bucket, storage_key, Config=OUTPUT_TRANSFER_CONFIG
+        )
+        extract_path.unlink()
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+        # Consume the iterator so upload errors are raised here
+        list(pool.map(upload, shards))
+
+
+def main() -> None:
+    """Cut the planet into per-shard extracts."""
+    require_env("RUN_ID", "INPUT_PREFIX", "OUTPUT_PREFIX", "S3_BUCKET")
+
+    s3 = get_s3_client()
+    bucket = get_s3_bucket()
+
+    print("=" * 60)
+    print("PARTITION STAGE")
+    print("=" * 60)
+    print(f"Run ID: {RUN_ID}")
+    print(f"Bucket: {bucket}")
+    print(f"Input Prefix: {INPUT_PREFIX}")
+    print(f"Output Prefix: {OUTPUT_PREFIX}")
+    print()
+
+    shards = load_manifest(s3, bucket)
+    print(f"Found {len(shards)} shards")
+
+    first = 0
+    if ARRAY_INDEX is not None:
+        first = int(ARRAY_INDEX) * EXTRACTS_PER_PASS
+        shards = shards[first : first + EXTRACTS_PER_PASS]
+        print(f"Array child {ARRAY_INDEX}: {len(shards)} shards")
+        if not shards:
+            # The array is never smaller than two children
+            print("No shards in this child's range, nothing to do")
+            return
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        work_dir = Path(tmpdir)
+        planet_path = work_dir / "planet.osm.pbf"
+        planet_key = f"{INPUT_PREFIX}/planet.osm.pbf"
+
+        print(f"Downloading s3://{bucket}/{planet_key}...")
+        s3.download_file(
+            bucket, planet_key, str(planet_path), Config=PLANET_TRANSFER_CONFIG
+        )
+        print(f"Planet file: {planet_path.stat().st_size / (1024**3):.1f} GB")
+
+        extracts_dir = work_dir / "extracts"
+        extracts_dir.mkdir()
+        for start in range(0, len(shards), EXTRACTS_PER_PASS):
+            batch = shards[start : start + EXTRACTS_PER_PASS]
+            print(
+                f"Extracting shards {first + start + 1}-{first + start + len(batch)}..."
+            )
+            extract_shards(planet_path, batch, extracts_dir)
+            upload_extracts(s3, bucket, batch, extracts_dir)
+
+        print(f"Uploaded extracts to s3://{bucket}/{OUTPUT_PREFIX}/extracts/")
+        print("Done!")
+
+
+if __name__ == "__main__":
+    main()
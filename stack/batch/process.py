@@ -11,19 +11,31 @@ Environment variables:
   - SHARD_Z: Web Mercator tile zoom
   - SHARD_X: Web Mercator tile x
   - SHARD_Y: Web Mercator tile y
-  - PLANET_FILE: Path/URL to planet file (optional, uses INPUT_PREFIX/planet.osm.pbf if not set)
+  - PLANET_FILE: Path/URL to planet file (optional, uses INPUT_PREFIX/planet.osm.pbf if not set);
+    only read when the partition stage left no INPUT_PREFIX/extracts/<SHARD_ID>.osm.pbf
+  - PLANET_CACHE_DIR: Host directory shared by workers to cache planet files by ETag
+    (default: /var/cache/osm; set to empty to disable)
   - H3_MIN_RESOLUTION: Minimum H3 resolution (default: 3)
   - H3_MAX_RESOLUTION: Maximum H3 resolution (default: 9)
 """
 
+import fcntl
+import functools
 import os
+import shutil
 import subprocess
 import tempfile
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Iterator
 
 import duckdb
+from botocore.exceptions import ClientError
 
 from common import (
+    OUTPUT_TRANSFER_CONFIG,
+    PLANET_TRANSFER_CONFIG,
+    configure_duckdb_resources,
     get_s3_client,
     get_s3_bucket,
     load_duckdb_extension,
@@ -40,34 +52,405 @@ SHARD_Z = os.environ.get("SHARD_Z")
 SHARD_X = os.environ.get("SHARD_X")
 SHARD_Y = os.environ.get("SHARD_Y")
 PLANET_FILE = os.environ.get("PLANET_FILE")
-H3_MIN_RESOLUTION = os.environ.get("H3_MIN_RESOLUTION")
-H3_MAX_RESOLUTION = os.environ.get("H3_MAX_RESOLUTION")
+PLANET_CACHE_DIR = os.environ.get("PLANET_CACHE_DIR", "/var/cache/osm")
 
 
-def filter_to_pois(input_pbf: Path, output_dir: Path) -> Path:
-    """Filter PBF to POI-relevant features using osmium."""
+def _load_h3_config() -> tuple[int, int]:
+    """Read, validate and clamp the H3 resolution range from the environment."""
+    h3_min_env = os.environ.get("H3_MIN_RESOLUTION")
+    h3_max_env = os.environ.get("H3_MAX_RESOLUTION")
+    try:
+        h3_min = int(h3_min_env) if h3_min_env is not None else 3
+        h3_max = int(h3_max_env) if h3_max_env is not None else 9
+    except ValueError:
+        raise ValueError("H3_MIN_RESOLUTION and H3_MAX_RESOLUTION must be integers")
+
+    h3_min = max(0, min(15, h3_min))
+    h3_max = max(0, min(15, h3_max))
+    if h3_min > h3_max:
+        h3_min, h3_max = h3_max, h3_min
+    return h3_min, h3_max
+
+
+H3_MIN, H3_MAX = _load_h3_config()
+
+# POI classification rules as (class, tag key, tag values), in priority order:
+# a feature gets the class of the first rule matching any of its tags.
+# A value of None matches any value of that key.
+POI_CLASS_RULES: list[tuple[str, str, tuple[str, ...] | None]] = [
+    ("restaurant", "amenity", ("restaurant", "food_court", "diner", "bbq")),
+    ("cafe_bakery", "amenity", ("cafe", "coffee_shop", "tea")),
+    ("bar_pub", "amenity", ("bar", "pub", "biergarten")),
+    ("fast_food", "amenity", ("fast_food", "food_truck", "ice_cream", "street_vendor")),
+    ("ice_cream", "shop", ("ice_cream", "dessert", "frozen_yogurt")),
+    ("grocery", "shop", ("supermarket", "convenience", "grocery", "marketplace")),
+    ("grocery", "amenity", ("marketplace",)),
+    (
+        "specialty_food",
+        "shop",
+        (
+            "bakery", "butcher", "cheese", "confectionery", "chocolate", "deli",
+            "fishmonger", "frozen_food", "greengrocer", "health_food", "organic",
+            "pastry", "tea", "coffee",
+        ),
+    ),
+    (
+        "retail",
+        "shop",
+        (
+            "mall", "department_store", "car", "clothes", "fashion", "shoes",
+            "electronics", "computer", "hardware", "doityourself", "furniture",
+            "jewelry", "toys", "books", "gift", "cosmetics",
+        ),
+    ),
+    (
+        "personal_services",
+        "amenity",
+        (
+            "spa", "sauna", "hairdresser", "beauty_salon", "laundry", "dry_cleaning",
+        ),
+    ),
+    ("personal_services", "shop", ("hairdresser", "beauty", "massage")),
+    ("professional_services", "amenity", ("coworking_space", "conference_centre")),
+    (
+        "professional_services",
+        "office",
+        (
+            "company", "lawyer", "architect", "estate_agent", "accountant",
+        ),
+    ),
+    ("finance", "amenity", ("bank", "atm", "bureau_de_change", "money_transfer")),
+    (
+        "lodging",
+        "tourism",
+        (
+            "hotel", "guest_house", "hostel", "motel", "apartment", "chalet",
+            "alpine_hut", "camp_site", "caravan_site",
+        ),
+    ),
+    ("transport", "amenity", ("bus_station", "ferry_terminal")),
+    ("transport", "railway", ("station", "halt", "stop", "tram_stop")),
+    ("transport", "public_transport", ("station",)),
+    ("transport", "aeroway", ("aerodrome", "terminal")),
+    (
+        "auto_services",
+        "amenity",
+        (
+            "fuel", "charging_station", "car_wash", "car_rental", "car_repair",
+        ),
+    ),
+    ("auto_services", "shop", ("car_repair", "tyres")),
+    ("parking", "amenity", ("parking", "bicycle_parking", "motorcycle_parking")),
+    (
+        "healthcare",
+        "amenity",
+        (
+            "hospital", "clinic", "doctors", "dentist", "pharmacy", "ambulance_station",
+        ),
+    ),
+    ("healthcare", "healthcare", None),
+    (
+        "education",
+        "amenity",
+        (
+            "school", "kindergarten", "college", "university", "music_school",
+            "language_school", "library",
+        ),
+    ),
+    (
+        "government",
+        "amenity",
+        (
+            "townhall", "courthouse", "police", "fire_station", "post_office",
+            "embassy",
+        ),
+    ),
+    ("government", "office", ("government",)),
+    (
+        "community",
+        "amenity",
+        (
+            "community_centre", "social_centre", "youth_centre", "social_facility",
+            "shelter",
+        ),
+    ),
+    (
+        "religious",
+        "amenity",
+        (
+            "place_of_worship", "church", "mosque", "temple", "synagogue",
+        ),
+    ),
+    ("culture", "tourism", ("museum", "gallery")),
+    ("culture", "amenity", ("arts_centre", "theatre", "concert_hall", "planetarium")),
+    (
+        "entertainment",
+        "amenity",
+        (
+            "cinema", "nightclub", "casino", "bowling_alley", "amusement_arcade",
+        ),
+    ),
+    ("entertainment", "leisure", ("bowling_alley", "escape_game")),
+    (
+        "sports_fitness",
+        "leisure",
+        (
+            "sports_centre", "fitness_centre", "gym", "swimming_pool", "stadium",
+            "pitch", "ice_rink", "golf_course",
+        ),
+    ),
+    (
+        "parks_outdoors",
+        "leisure",
+        (
+            "park", "garden", "nature_reserve", "playground", "dog_park",
+        ),
+    ),
+    ("parks_outdoors", "tourism", ("picnic_site", "viewpoint")),
+    ("parks_outdoors", "natural", ("beach",)),
+    ("landmark", "tourism", ("attraction", "information")),
+    ("landmark", "historic", ("monument", "memorial", "castle", "ruins")),
+    ("landmark", "man_made", ("lighthouse", "tower")),
+    ("animal_services", "amenity", ("veterinary", "animal_boarding", "animal_shelter")),
+    ("animal_services", "shop", ("pet",)),
+    ("retail", "shop", None),
+    ("misc", "amenity", None),
+    ("misc", "leisure", None),
+    ("misc", "tourism", None),
+]
+
+# poi_rules table rows (tag_key, tag_value, priority, class), flattened once
+POI_RULE_ROWS = [
+    (key, value, priority, cls)
+    for priority, (cls, key, values) in enumerate(POI_CLASS_RULES)
+    for value in (values or (None,))
+]
+
+
+# Resolved on first use; the H3 extension does not change within a process
+_h3_cell_to_string_fn: str | None = None
+
+
+def resolve_h3_cell_to_string(conn: duckdb.DuckDBPyConnection) -> str:
+    """Return the H3 extension's cell-to-string function name.
+
+    DuckDB H3 extension has had naming differences across versions.
+    Resolve the function name dynamically to keep the pipeline portable.
+    """
+    global _h3_cell_to_string_fn
+    if _h3_cell_to_string_fn is not None:
+        return _h3_cell_to_string_fn
+
+    candidates = ("h3_cell_to_cell_string", "h3_cell_to_string")
+    available = {
+        row[0]
+        for row in conn.execute(
+            "SELECT DISTINCT function_name FROM duckdb_functions() "
+            "WHERE function_name IN (?, ?)",
+            list(candidates),
+        ).fetchall()
+    }
+    for candidate in candidates:
+        if candidate in available:
+            _h3_cell_to_string_fn = candidate
+            print(f"DuckDB H3: using {candidate}()")
+            return candidate
+
+    raise RuntimeError(
+        "DuckDB H3 extension is missing a cell-to-string function; expected one of "
+        "'h3_cell_to_cell_string' or 'h3_cell_to_string'."
+    )
+
+
+@functools.cache
+def build_h3_columns_sql(h3_cell_to_string_fn: str) -> str:
+    """Build the h3_r{H3_MIN}..h3_r{H3_MAX} output column expressions.
+
+    Index once at the finest resolution; coarser cells are cheap parent
+    lookups on that index rather than repeated lat/lng conversions.
+    """
+    h3_columns = []
+    for res in range(H3_MIN, H3_MAX + 1):
+        cell = "h3_max_cell" if res == H3_MAX else f"h3_cell_to_parent(h3_max_cell, {res})"
+        h3_columns.append(f"{h3_cell_to_string_fn}({cell}) as h3_r{res}")
+    return ",\n            ".join(h3_columns)
+
+
+def evict_planet_cache(cache_dir: Path, needed_bytes: int) -> None:
+    """Delete least recently used cached planets until `needed_bytes` fit.
+
+    Partial downloads left by killed workers go first; one is only removed
+    when nobody holds the download lock for its planet.
+    """
+    for partial in cache_dir.glob("planet-*.osm.part*"):
+        lock_path = cache_dir / (partial.name.split(".part")[0] + ".download")
+        with open(lock_path, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            print(f"Removing abandoned partial download {partial.name}")
+            partial.unlink(missing_ok=True)
+
+    entries = sorted(cache_dir.glob("planet-*.osm.pbf"), key=lambda p: p.stat().st_mtime)
+    for entry in entries:
+        if shutil.disk_usage(cache_dir).free >= needed_bytes:
+            return
+        lock_path = entry.with_suffix(".lock")
+        with open(lock_path, "a") as lock:
+            # Skip entries another worker is still reading
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            print(f"Evicting cached planet {entry.name}")
+            entry.unlink(missing_ok=True)
+
+
+@contextmanager
+def cached_planet(s3, bucket: str, key: str, cache_dir: Path) -> Iterator[Path]:
+    """Yield a planet file from the host cache, downloading it once per ETag.
+
+    A shared lock on a sidecar file is held while the planet is in use, so
+    any number of workers read it concurrently and eviction never removes a
+    planet another worker is reading. Downloads are serialized by a separate
+    exclusive lock, so waiting for one never waits on the readers.
+    """
+    head = s3.head_object(Bucket=bucket, Key=key)
+    etag = head["ETag"].strip('"')
+    cached_path = cache_dir / f"planet-{etag}.osm.pbf"
+
+    with open(cached_path.with_suffix(".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        if not cached_path.exists():
+            with open(cached_path.with_suffix(".download"), "a") as download_lock:
+                fcntl.flock(download_lock, fcntl.LOCK_EX)
+                # Another worker may have finished the download while we waited
+                if not cached_path.exists():
+                    print(f"Downloading s3://{bucket}/{key} to cache...")
+                    partial_path = cached_path.with_suffix(".part")
+                    # s3transfer writes to "<partial>.<random>" before renaming
+                    partials = f"{partial_path.name}*"
+                    for stale in cache_dir.glob(partials):
+                        stale.unlink(missing_ok=True)
+                    evict_planet_cache(cache_dir, head["ContentLength"])
+                    try:
+                        s3.download_file(
+                            bucket,
+                            key,
+                            str(partial_path),
+                            Config=PLANET_TRANSFER_CONFIG,
+                        )
+                    except BaseException:
+                        for partial in cache_dir.glob(partials):
+                            partial.unlink(missing_ok=True)
+                        raise
+                    partial_path.rename(cached_path)
+        else:
+            print(f"Using cached planet file: {cached_path}")
+            os.utime(cached_path)
+        yield cached_path
+
+
+@contextmanager
+def planet_file(s3, bucket: str, work_dir: Path) -> Iterator[Path]:
+    """Yield a local planet file, preferring the shared host cache."""
+    # Use provided planet file directly if it's a local path
+    if PLANET_FILE and Path(PLANET_FILE).exists():
+        print(f"Using local planet file: {PLANET_FILE}")
+        yield Path(PLANET_FILE)
+        return
+
+    # Otherwise it's an S3 key, defaulting to the run-specific location
+    planet_key = PLANET_FILE or f"{INPUT_PREFIX}/planet.osm.pbf"
+
+    if PLANET_CACHE_DIR:
+        cache_dir = Path(PLANET_CACHE_DIR)
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            print(f"Planet cache unavailable ({e}), downloading to work dir")
+        else:
+            with cached_planet(s3, bucket, planet_key, cache_dir) as planet_path:
+                yield planet_path
+            return
+
+    planet_path = work_dir / "planet.osm.pbf"
+    print(f"Downloading s3://{bucket}/{planet_key}...")
+    s3.download_file(
+        bucket, planet_key, str(planet_path), Config=PLANET_TRANSFER_CONFIG
+    )
+    try:
+        yield planet_path
+    finally:
+        # Remove planet file to free space
+        planet_path.unlink()
+
+
+def download_shard_extract(s3, bucket: str, work_dir: Path) -> Path | None:
+    """Download this shard's extract from the partition stage, if there is one."""
+    extract_key = f"{INPUT_PREFIX}/extracts/{SHARD_ID}.osm.pbf"
+    extract_path = work_dir / "extract.osm.pbf"
+    try:
+        s3.download_file(
+            bucket, extract_key, str(extract_path), Config=PLANET_TRANSFER_CONFIG
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise
+        print("No shard extract found, cutting the shard from the planet")
+        return None
+    print(f"Shard extract: {extract_path.stat().st_size / (1024**2):.1f} MB")
+    return extract_path
+
+
+def filter_to_pois(pbf_path: Path, bbox: dict | None, output_dir: Path) -> Path:
+    """Filter a PBF to POI-relevant features, cutting `bbox` out first if given.
+
+    A per-shard extract from the partition stage is already cut and is
+    filtered directly. Both osmium steps read their input more than once
+    (to complete ways and to add referenced nodes), so the bounding-box
+    extract is written to a file rather than piped into tags-filter.
+    """
     output_path = output_dir / "pois.osm.pbf"
 
-    # First pass: keep only features with names
-    named_pbf = output_dir / "named.osm.pbf"
+    extract_path = None
+    if bbox is not None:
+        extract_path = output_dir / "bbox.osm.pbf"
+        subprocess.run(
+            [
+                "osmium",
+                "extract",
+                "--bbox",
+                f"{bbox['west']},{bbox['south']},{bbox['east']},{bbox['north']}",
+                "--strategy",
+                "smart",
+                str(pbf_path),
+                "-o",
+                str(extract_path),
+            ],
+            check=True,
+        )
+        pbf_path = extract_path
+
+    # First pass: keep only features with names. osmium ORs the expressions
+    # of a single run, so "named AND a POI key" takes two passes; on a shard
+    # extract both are cheap, and they keep unnamed landcover, rail and trees
+    # (and all their nodes) out of the DuckDB load.
+    named_path = output_dir / "named.osm.pbf"
     subprocess.run(
-        [
-            "osmium",
-            "tags-filter",
-            str(input_pbf),
-            "nw/name",
-            "-o",
-            str(named_pbf),
-        ],
+        ["osmium", "tags-filter", str(pbf_path), "nw/name", "-o", str(named_path)],
         check=True,
     )
+    if extract_path is not None:
+        extract_path.unlink()
 
     # Second pass: filter to POI categories
     subprocess.run(
         [
             "osmium",
             "tags-filter",
-            str(named_pbf),
+            str(named_path),
             "nw/amenity",
             "nw/shop",
             "nw/leisure",
@@ -86,234 +469,193 @@ def filter_to_pois(input_pbf: Path, output_dir: Path) -> Path:
         check=True,
     )
 
-    named_pbf.unlink()
+    named_path.unlink()
     print(f"Filtered to POIs: {output_path.stat().st_size / (1024**2):.1f} MB")
     return output_path
 
 
-def pbf_to_geojson(pbf_path: Path, output_dir: Path) -> Path:
-    """Convert PBF to newline-delimited GeoJSON."""
-    output_path = output_dir / "pois.ndjson"
-
-    subprocess.run(
-        [
-            "osmium",
-            "export",
-            str(pbf_path),
-            "-o",
-            str(output_path),
-            "-f",
-            "geojsonseq",
-            "-x",
-            "print_record_separator=false",
-            "-u",
-            "type_id",
-            "--geometry-types=point,polygon",
-        ],
-        check=True,
-    )
-
-    print(f"Converted to GeoJSON: {output_path.stat().st_size / (1024**2):.1f} MB")
-    return output_path
-
-
 def process_to_parquet(
-    geojson_path: Path, shard_id: str, output_dir: Path
+    pbf_path: Path, output_dir: Path
 ) -> Path | None:
-    """Process GeoJSON to Parquet with POI classification."""
+    """Process POI PBF to Parquet with POI classification."""
     output_path = output_dir / "data.parquet"
 
     conn = duckdb.connect()
+    configure_duckdb_resources(conn, temp_dir=output_dir / "duckdb_tmp")
     load_duckdb_extension(conn, "spatial", "INSTALL spatial")
     load_duckdb_extension(conn, "h3", "INSTALL h3 FROM community")
 
-    # DuckDB H3 extension has had naming differences across versions.
-    # Resolve the function name dynamically to keep the pipeline portable.
-    h3_cell_to_string_fn = None
-    for candidate in ("h3_cell_to_cell_string", "h3_cell_to_string"):
-        exists = conn.execute(
-            "SELECT 1 FROM duckdb_functions() WHERE function_name = ? LIMIT 1",
-            [candidate],
-        ).fetchone()
-        if exists:
-            h3_cell_to_string_fn = candidate
-            break
-    if h3_cell_to_string_fn is None:
-        raise RuntimeError(
-            "DuckDB H3 extension is missing a cell-to-string function; expected one of "
-            "'h3_cell_to_cell_string' or 'h3_cell_to_string'."
-        )
-    print(f"DuckDB H3: using {h3_cell_to_string_fn}()")
+    h3_cell_to_string_fn = resolve_h3_cell_to_string(conn)
 
-    try:
-        h3_min = int(H3_MIN_RESOLUTION) if H3_MIN_RESOLUTION is not None else 3
-        h3_max = int(H3_MAX_RESOLUTION) if H3_MAX_RESOLUTION is not None else 9
-    except ValueError:
-        raise ValueError("H3_MIN_RESOLUTION and H3_MAX_RESOLUTION must be integers")
-
-    h3_min = max(0, min(15, h3_min))
-    h3_max = max(0, min(15, h3_max))
-    if h3_min > h3_max:
-        h3_min, h3_max = h3_max, h3_min
+    conn.execute(
+        "CREATE TEMP TABLE poi_rules "
+        "(tag_key VARCHAR, tag_value VARCHAR, priority INTEGER, class VARCHAR)"
+    )
+    conn.executemany("INSERT INTO poi_rules VALUES (?, ?, ?, ?)", POI_RULE_ROWS)
 
-    h3_columns = []
-    for res in range(h3_min, h3_max + 1):
-        h3_columns.append(
-            f"{h3_cell_to_string_fn}(h3_latlng_to_cell(ST_Y(centroid)::DOUBLE, ST_X(centroid)::DOUBLE, "
-            f"{res})) as h3_r{res}"
-        )
-    h3_columns_sql = ",\n            ".join(h3_columns)
+    h3_columns_sql = build_h3_columns_sql(h3_cell_to_string_fn)
 
-    # Check if there's any data
-    count = conn.sql(
+    # Decode the PBF once into an in-memory table; both the tag and the
+    # node-coordinate passes of the main query read from it.
+    conn.sql(
         f"""
-        SELECT COUNT(*) FROM read_json('{geojson_path}',
-            columns={{id: 'VARCHAR', type: 'VARCHAR', geometry: 'JSON', properties: 'JSON'}},
-            maximum_object_size=10485760
-        )
+        CREATE TEMP TABLE osm AS
+        SELECT kind, id, tags, refs, lat, lon
+        FROM ST_ReadOSM('{pbf_path}')
+        WHERE kind IN ('node', 'way')
     """
-    ).fetchone()[0]
-
-    if count == 0:
-        print("No features found")
-        return None
-
-    print(f"Processing {count:,} features...")
+    )
 
-    # Main processing query with POI classification
+    # Main processing query with POI classification. The result is kept in
+    # memory so the stats below don't have to re-read the written Parquet.
     query = f"""
-    COPY (
-        WITH raw_features AS (
+    CREATE TEMP TABLE pois AS (
+        -- Named nodes and closed ways (areas); open ways are not POIs.
+        -- Everything up to the class join works on tags only, so no geometry
+        -- is built for features that end up unclassified.
+        WITH candidates AS MATERIALIZED (
+            SELECT kind, id, tags, refs, lat, lon
+            FROM osm
+            WHERE tags['name'] IS NOT NULL
+              AND (kind = 'node' OR (len(refs) >= 4 AND refs[1] = refs[-1]))
+        ),
+        -- One row per tag, so classification is a hash join against
+        -- poi_rules instead of a CASE evaluated rule by rule.
+        feature_tags AS (
+            SELECT
+                kind,
+                id,
+                unnest(map_keys(tags)) as tag_key,
+                unnest(map_values(tags)) as tag_value
+            FROM candidates
+        ),
+        tag_matches AS (
+            SELECT t.kind, t.id, r.priority, r.class
+            FROM feature_tags t
+            JOIN poi_rules r ON r.tag_key = t.tag_key AND r.tag_value = t.tag_value
+            UNION ALL
+            SELECT t.kind, t.id, r.priority, r.class
+            FROM feature_tags t
+            JOIN poi_rules r ON r.tag_key = t.tag_key AND r.tag_value IS NULL
+        ),
+        classified AS MATERIALIZED (
+            SELECT c.*, m.class
+            FROM candidates c
+            JOIN (
+                SELECT kind, id, arg_min(class, priority) as class
+                FROM tag_matches
+                GROUP BY kind, id
+            ) m USING (kind, id)
+        ),
+        -- Explode the refs of classified ways so each ring can be rebuilt
+        -- from node coordinates.
+        way_refs AS (
+            SELECT
+                id,
+                unnest(refs) as ref,
+                generate_subscripts(refs, 1) as idx,
+                len(refs) as ref_count
+            FROM classified
+            WHERE kind = 'way'
+        ),
+        way_centroids AS (
             SELECT
-                id as osm_id,
-                properties->>'@type' as osm_type,
-                properties->>'name' as name,
-                properties->>'amenity' as amenity,
-                properties->>'shop' as shop,
-                properties->>'leisure' as leisure,
-                properties->>'tourism' as tourism,
-                properties->>'office' as office,
-                properties->>'healthcare' as healthcare,
-                properties->>'railway' as railway,
-                properties->>'aeroway' as aeroway,
-                properties->>'historic' as historic,
-                properties->>'man_made' as man_made,
-                properties->>'natural' as "natural",
-                properties->>'public_transport' as public_transport,
-                properties->>'cuisine' as cuisine,
-                properties->>'opening_hours' as opening_hours,
-                properties->>'phone' as phone,
-                properties->>'website' as website,
-                properties->>'brand' as brand,
-                properties->>'operator' as "operator",
-                ST_Centroid(ST_GeomFromGeoJSON(geometry)) as centroid
-            FROM read_json('{geojson_path}',
-                columns={{id: 'VARCHAR', type: 'VARCHAR', geometry: 'JSON', properties: 'JSON'}},
-                maximum_object_size=10485760
-            )
-            WHERE properties->>'name' IS NOT NULL
-              AND geometry IS NOT NULL
+                r.id,
+                ST_Centroid(ST_MakePolygon(ST_MakeLine(
+                    list(ST_Point(n.lon, n.lat) ORDER BY r.idx)
+                ))) as centroid
+            FROM way_refs r
+            JOIN osm n ON n.kind = 'node' AND n.id = r.ref
+            GROUP BY r.id
+            HAVING count(*) = any_value(r.ref_count)
         ),
-        classified AS (
+        -- Nodes already are points, so their coordinates pass straight
+        -- through; only ways go through the geometry functions.
+        located AS (
+            SELECT
+                'n' || id as osm_id,
+                'node' as osm_type,
+                tags,
+                class,
+                lon,
+                lat
+            FROM classified
+            WHERE kind = 'node'
+            UNION ALL
+            SELECT
+                'w' || c.id as osm_id,
+                'way' as osm_type,
+                c.tags,
+                c.class,
+                ST_X(w.centroid)::DOUBLE as lon,
+                ST_Y(w.centroid)::DOUBLE as lat
+            FROM classified c
+            JOIN way_centroids w ON c.kind = 'way' AND c.id = w.id
+        ),
+        indexed AS (
             SELECT
                 *,
-                CASE
-                    WHEN amenity IN ('restaurant', 'food_court', 'diner', 'bbq') THEN 'restaurant'
-                    WHEN amenity IN ('cafe', 'coffee_shop', 'tea') THEN 'cafe_bakery'
-                    WHEN amenity IN ('bar', 'pub', 'biergarten') THEN 'bar_pub'
-                    WHEN amenity IN ('fast_food', 'food_truck', 'ice_cream', 'street_vendor') THEN 'fast_food'
-                    WHEN shop IN ('ice_cream', 'dessert', 'frozen_yogurt') THEN 'ice_cream'
-                    WHEN shop IN ('supermarket', 'convenience', 'grocery', 'marketplace') THEN 'grocery'
-                    WHEN amenity = 'marketplace' THEN 'grocery'
-                    WHEN shop IN ('bakery', 'butcher', 'cheese', 'confectionery', 'chocolate',
-                                  'deli', 'fishmonger', 'frozen_food', 'greengrocer',
-                                  'health_food', 'organic', 'pastry', 'tea', 'coffee') THEN 'specialty_food'
-                    WHEN shop IN ('mall', 'department_store', 'car', 'clothes', 'fashion',
-                                  'shoes', 'electronics', 'computer', 'hardware', 'doityourself',
-                                  'furniture', 'jewelry', 'toys', 'books', 'gift', 'cosmetics') THEN 'retail'
-                    WHEN amenity IN ('spa', 'sauna', 'hairdresser', 'beauty_salon', 'laundry', 'dry_cleaning') THEN 'personal_services'
-                    WHEN shop IN ('hairdresser', 'beauty', 'massage') THEN 'personal_services'
-                    WHEN amenity IN ('coworking_space', 'conference_centre') THEN 'professional_services'
-                    WHEN office IN ('company', 'lawyer', 'architect', 'estate_agent', 'accountant') THEN 'professional_services'
-                    WHEN amenity IN ('bank', 'atm', 'bureau_de_change', 'money_transfer') THEN 'finance'
-                    WHEN tourism IN ('hotel', 'guest_house', 'hostel', 'motel', 'apartment',
-                                     'chalet', 'alpine_hut', 'camp_site', 'caravan_site') THEN 'lodging'
-                    WHEN amenity IN ('bus_station', 'ferry_terminal') THEN 'transport'
-                    WHEN railway IN ('station', 'halt', 'stop', 'tram_stop') THEN 'transport'
-                    WHEN public_transport = 'station' THEN 'transport'
-                    WHEN aeroway IN ('aerodrome', 'terminal') THEN 'transport'
-                    WHEN amenity IN ('fuel', 'charging_station', 'car_wash', 'car_rental', 'car_repair') THEN 'auto_services'
-                    WHEN shop IN ('car_repair', 'tyres') THEN 'auto_services'
-                    WHEN amenity IN ('parking', 'bicycle_parking', 'motorcycle_parking') THEN 'parking'
-                    WHEN amenity IN ('hospital', 'clinic', 'doctors', 'dentist', 'pharmacy', 'ambulance_station') THEN 'healthcare'
-                    WHEN healthcare IS NOT NULL THEN 'healthcare'
-                    WHEN amenity IN ('school', 'kindergarten', 'college', 'university',
-                                     'music_school', 'language_school', 'library') THEN 'education'
-                    WHEN amenity IN ('townhall', 'courthouse', 'police', 'fire_station',
-                                     'post_office', 'embassy') THEN 'government'
-                    WHEN office = 'government' THEN 'government'
-                    WHEN amenity IN ('community_centre', 'social_centre', 'youth_centre',
-                                     'social_facility', 'shelter') THEN 'community'
-                    WHEN amenity IN ('place_of_worship', 'church', 'mosque', 'temple', 'synagogue') THEN 'religious'
-                    WHEN tourism IN ('museum', 'gallery') THEN 'culture'
-                    WHEN amenity IN ('arts_centre', 'theatre', 'concert_hall', 'planetarium') THEN 'culture'
-                    WHEN amenity IN ('cinema', 'nightclub', 'casino', 'bowling_alley', 'amusement_arcade') THEN 'entertainment'
-                    WHEN leisure IN ('bowling_alley', 'escape_game') THEN 'entertainment'
-                    WHEN leisure IN ('sports_centre', 'fitness_centre', 'gym', 'swimming_pool',
-                                     'stadium', 'pitch', 'ice_rink', 'golf_course') THEN 'sports_fitness'
-                    WHEN leisure IN ('park', 'garden', 'nature_reserve', 'playground', 'dog_park') THEN 'parks_outdoors'
-                    WHEN tourism IN ('picnic_site', 'viewpoint') THEN 'parks_outdoors'
-                    WHEN "natural" = 'beach' THEN 'parks_outdoors'
-                    WHEN tourism IN ('attraction', 'information') THEN 'landmark'
-                    WHEN historic IN ('monument', 'memorial', 'castle', 'ruins') THEN 'landmark'
-                    WHEN man_made IN ('lighthouse', 'tower') THEN 'landmark'
-                    WHEN amenity IN ('veterinary', 'animal_boarding', 'animal_shelter') THEN 'animal_services'
-                    WHEN shop = 'pet' THEN 'animal_services'
-                    WHEN shop IS NOT NULL THEN 'retail'
-                    WHEN amenity IS NOT NULL OR leisure IS NOT NULL OR tourism IS NOT NULL THEN 'misc'
-                    ELSE NULL
-                END as class
-            FROM raw_features
+                h3_latlng_to_cell(lat, lon, {H3_MAX}) as h3_max_cell
+            FROM located
         )
+        -- Output tags are looked up only for features that got a class;
+        -- classification itself works off the unnested tags.
         SELECT
             osm_id,
             osm_type,
-            name,
+            tags['name'] as name,
             class,
-            ST_X(centroid)::DOUBLE as lon,
-            ST_Y(centroid)::DOUBLE as lat,
+            lon,
+            lat,
             {h3_columns_sql},
-            '{shard_id}' as shard_id,
-            amenity,
-            shop,
-            leisure,
-            tourism,
-            cuisine,
-            opening_hours,
-            phone,
-            website,
-            brand,
-            "operator"
-        FROM classified
-        WHERE class IS NOT NULL
-    ) TO '{output_path}' (FORMAT PARQUET, COMPRESSION SNAPPY)
+            tags['amenity'] as amenity,
+            tags['shop'] as shop,
+            tags['leisure'] as leisure,
+            tags['tourism'] as tourism,
+            tags['cuisine'] as cuisine,
+            tags['opening_hours'] as opening_hours,
+            tags['phone'] as phone,
+            tags['website'] as website,
+            tags['brand'] as brand,
+            tags['operator'] as "operator",
+            h3_max_cell
+        FROM indexed
+    )
     """
 
     conn.sql(query)
 
-    # Get stats
+    # Get stats; an empty result means the shard has no POIs, so skip writing
     stats = conn.sql(
-        f"""
-        SELECT COUNT(*) as total, COUNT(DISTINCT class) as classes
-        FROM read_parquet('{output_path}')
-    """
+        "SELECT COUNT(*) as total, COUNT(DISTINCT class) as classes FROM pois"
     ).fetchone()
 
     print(f"Output: {stats[0]:,} POIs in {stats[1]} classes")
+    if stats[0] == 0:
+        conn.close()
+        return None
+
+    conn.sql(
+        f"""
+        COPY (
+            SELECT * EXCLUDE (h3_max_cell)
+            FROM pois
+            -- Cluster rows spatially so row-group min/max stats on the H3
+            -- columns let readers skip most of the file.
+            ORDER BY h3_max_cell
+        ) TO '{output_path}' (
+            FORMAT PARQUET,
+            COMPRESSION ZSTD,
+            COMPRESSION_LEVEL 3,
+            ROW_GROUP_SIZE 50000
+        )
+    """
+    )
+
     print(f"File size: {output_path.stat().st_size / (1024**2):.1f} MB")
 
     conn.close()
-    return output_path if stats[0] > 0 else None
+    return output_path
 
 
 def main() -> None:
@@ -336,62 +678,25 @@ def main() -> None:
     with tempfile.TemporaryDirectory() as tmpdir:
         work_dir = Path(tmpdir)
 
-        # Download or use provided planet file
-        planet_path = work_dir / "planet.osm.pbf"
-        if PLANET_FILE:
-            # Use provided planet file directly if it's a local path
-            if Path(PLANET_FILE).exists():
-                print(f"Using local planet file: {PLANET_FILE}")
-                import shutil
-
-                shutil.copy2(PLANET_FILE, planet_path)
-            else:
-                # Assume it's a S3 key
-                print(f"Downloading planet file from S3: {PLANET_FILE}")
-                s3.download_file(bucket, PLANET_FILE, str(planet_path))
-        else:
-            # Default to run-specific location
-            planet_key = f"{INPUT_PREFIX}/planet.osm.pbf"
-            print(f"Downloading s3://{bucket}/{planet_key}...")
-            s3.download_file(bucket, planet_key, str(planet_path))
-
-        print(f"Downloaded {planet_path.stat().st_size / (1024**3):.1f} GB")
-
         # Get tile bounding box for filtering
         bbox = get_tile_bbox(int(SHARD_Z), int(SHARD_X), int(SHARD_Y))
         print(f"Bounding box: {bbox}")
 
-        # Filter PBF to this H3 cell's bounding box
-        filtered_pbf = work_dir / "filtered.osm.pbf"
-        print("Filtering PBF to bounding box...")
-        subprocess.run(
-            [
-                "osmium",
-                "extract",
-                "--bbox",
-                f"{bbox['west']},{bbox['south']},{bbox['east']},{bbox['north']}",
-                "--strategy",
-                "smart",
-                str(planet_path),
-                "-o",
-                str(filtered_pbf),
-            ],
-            check=True,
-        )
-        # Remove planet file to free space
-        planet_path.unlink()
-        print(f"Filtered to {filtered_pbf.stat().st_size / (1024**2):.1f} MB")
-
-        # Filter to POI-relevant tags
-        poi_pbf = filter_to_pois(filtered_pbf, work_dir)
-        filtered_pbf.unlink()
+        extract_path = download_shard_extract(s3, bucket, work_dir)
+        if extract_path is not None:
+            print("Filtering shard extract to POIs...")
+            poi_pbf = filter_to_pois(extract_path, None, work_dir)
+            extract_path.unlink()
+        else:
+            with planet_file(s3, bucket, work_dir) as planet_path:
+                print(f"Planet file: {planet_path.stat().st_size / (1024**3):.1f} GB")
 
-        # Convert to GeoJSON
-        geojson_path = pbf_to_geojson(poi_pbf, work_dir)
-        poi_pbf.unlink()
+                # Cut this shard's bounding box and filter to POI-relevant tags
+                print("Extracting POIs for bounding box...")
+                poi_pbf = filter_to_pois(planet_path, bbox, work_dir)
 
-        # Process to Parquet with DuckDB
-        parquet_path = process_to_parquet(geojson_path, SHARD_ID, work_dir)
+        # Process to Parquet with DuckDB, reading the PBF directly
+        parquet_path = process_to_parquet(poi_pbf, work_dir)
 
         if parquet_path is None:
             print("No POIs found in this shard, skipping upload")
@@ -403,7 +708,9 @@ def main() -> None:
         # Upload to S3
         storage_key = f"{OUTPUT_PREFIX}/shards/{SHARD_ID}/data.parquet"
         print(f"Uploading to s3://{bucket}/{storage_key}...")
-        s3.upload_file(str(parquet_path), bucket, storage_key)
+        s3.upload_file(
+            str(parquet_path), bucket, storage_key, Config=OUTPUT_TRANSFER_CONFIG
+        )
         print("Done!")
 
 
@@ -5,16 +5,18 @@ OSM-H3 batch processor dispatcher.
 This is a backward-compatible wrapper that dispatches to individual stage scripts.
 Handles multiple stages of the pipeline based on STAGE environment variable:
 - download: Fetch planet.osm.pbf from OSM mirrors
+- partition: Cut the planet into one PBF extract per shard
 - process: Process a single H3 shard to Parquet
 - merge: Combine all shard outputs into final dataset
 
 For direct script execution, use:
   - download.py
+  - partition.py
   - process.py
   - merge.py
 
 Environment variables:
-  - STAGE: Which stage to run (download, process, merge)
+  - STAGE: Which stage to run (download, partition, process, merge)
   - RUN_ID: Unique identifier for this pipeline run
   - STORAGE_TYPE: Storage backend (local, s3) - defaults to 'local'
   - STORAGE_PATH: Base path for storage (local dir or S3 bucket)
@@ -29,6 +31,10 @@ For 'process' stage:
   - SHARD_Y: Web Mercator tile y
   - PLANET_FILE: Optional planet file path/key
 
+For 'partition' stage:
+  - EXTRACTS_PER_PASS: Shards cut per pass over the planet (default: 500)
+  - AWS_BATCH_JOB_ARRAY_INDEX: Pass this array child cuts (set by Batch)
+
 For 'download' stage:
   - PLANET_URL: Optional custom URL for planet file
 """
@@ -64,6 +70,10 @@ def main() -> None:
         import download
 
         download.main()
+    elif STAGE == "partition":
+        import partition
+
+        partition.main()
     elif STAGE == "process":
         import process
 
@@ -74,7 +84,7 @@ def main() -> None:
         merge.main()
     else:
         print(f"ERROR: Unknown stage '{STAGE}'")
-        print("Valid stages: download, process, merge")
+        print("Valid stages: download, partition, process, merge")
         sys.exit(1)
 
 
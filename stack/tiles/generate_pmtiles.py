@@ -2,8 +2,8 @@
 """
 Generate PMTiles from Parquet POI data.
 
-Downloads all Parquet files from S3, converts to GeoJSON,
-runs tippecanoe to generate PMTiles, and uploads to S3.
+Downloads all Parquet files from S3, streams them as GeoJSON from DuckDB
+into tippecanoe to generate PMTiles, and uploads to S3.
 
 Environment variables:
   - S3_BUCKET: S3 bucket name
@@ -12,130 +12,153 @@ Environment variables:
   - PMTILES_OUTPUT: Output filename (default: pois.pmtiles)
 """
 
-import json
+import functools
 import os
 import subprocess
 import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import BinaryIO
 
 import boto3
-import pyarrow.parquet as pq
+import duckdb
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 S3_BUCKET = os.environ.get("S3_BUCKET")
 OUTPUT_PREFIX = os.environ.get("OUTPUT_PREFIX", "").lstrip("/")
 RUN_ID = os.environ.get("RUN_ID")
 PMTILES_OUTPUT = os.environ.get("PMTILES_OUTPUT", "pois.pmtiles")
 
+DOWNLOAD_WORKERS = 16
+# Features between progress lines while streaming GeoJSON to tippecanoe
+PROGRESS_INTERVAL = 1_000_000
+# Multi-GB Parquet downloads and PMTiles uploads: 64 MB parts, 16 in flight
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=64 * 1024**2,
+    multipart_chunksize=64 * 1024**2,
+    max_concurrency=16,
+    use_threads=True,
+)
+
+# Feature properties copied through when present and non-empty, in addition
+# to name, class and any H3 columns (e.g. h3_r3..h3_r9)
+OPTIONAL_PROPERTIES = [
+    "state",
+    "shard_id",
+    "osm_id",
+    "osm_type",
+    "amenity",
+    "shop",
+    "cuisine",
+    "brand",
+    "opening_hours",
+    "website",
+    "phone",
+    "operator",
+]
+
+
+@functools.cache
+def get_s3_client():
+    """Get the shared boto3 S3 client, pooled for the parallel transfers."""
+    return boto3.client(
+        "s3",
+        config=Config(
+            max_pool_connections=64,
+            retries={"max_attempts": 10, "mode": "adaptive"},
+            tcp_keepalive=True,
+        ),
+    )
+
 
 def download_parquet_files(bucket: str, work_dir: Path) -> list[Path]:
     """Download all Parquet files from S3."""
-    s3 = boto3.client("s3")
+    s3 = get_s3_client()
     parquet_dir = work_dir / "parquet"
     parquet_dir.mkdir(exist_ok=True)
 
     print("Listing Parquet files in S3...")
-    response = s3.list_objects_v2(Bucket=bucket, Prefix="parquet/")
-
-    files = []
-    for obj in response.get("Contents", []):
-        key = obj["Key"]
-        if key.endswith(".parquet"):
-            local_path = parquet_dir / Path(key).name
-            print(f"  Downloading {key}...")
-            s3.download_file(bucket, key, str(local_path))
-            files.append(local_path)
-
-    # Handle pagination
-    while response.get("IsTruncated"):
-        response = s3.list_objects_v2(
-            Bucket=bucket,
-            Prefix="parquet/",
-            ContinuationToken=response["NextContinuationToken"],
+    keys = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix="parquet/"):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(".parquet"):
+                keys.append(obj["Key"])
+
+    def download_one(key: str) -> Path:
+        local_path = parquet_dir / Path(key).name
+        print(f"  Downloading {key}...")
+        s3.download_file(
+            bucket, key, str(local_path), Config=TRANSFER_CONFIG
         )
-        for obj in response.get("Contents", []):
-            key = obj["Key"]
-            if key.endswith(".parquet"):
-                local_path = parquet_dir / Path(key).name
-                print(f"  Downloading {key}...")
-                s3.download_file(bucket, key, str(local_path))
-                files.append(local_path)
+        return local_path
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        files = list(pool.map(download_one, keys))
 
     print(f"Downloaded {len(files)} Parquet files")
     return files
 
 
-def parquet_to_geojson(parquet_files: list[Path], output_path: Path) -> int:
-    """Convert Parquet files to newline-delimited GeoJSON."""
-    print("Converting Parquet to GeoJSON...")
-    total_features = 0
+def write_geojson_features(parquet_files: list[Path], out: BinaryIO) -> int:
+    """Write Parquet POIs to a stream as newline-delimited GeoJSON."""
+    conn = duckdb.connect()
 
-    def _require_columns(df: dict, cols: list[str], pq_file: Path) -> None:
-        missing = [c for c in cols if c not in df]
-        if missing:
-            raise KeyError(
-                f"Missing required Parquet columns {missing} in {pq_file.name}. "
-                f"Available: {sorted(df.keys())}"
-            )
-
-    with open(output_path, "w") as f:
-        for pq_file in parquet_files:
-            print(f"  Processing {pq_file.name}...")
-            table = pq.read_table(pq_file)
-            df = table.to_pydict()
-
-            _require_columns(df, ["lon", "lat", "name", "class"], pq_file)
-            num_rows = len(df["name"])
-            for i in range(num_rows):
-                feature = {
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Point",
-                        "coordinates": [df["lon"][i], df["lat"][i]],
-                    },
-                    "properties": {
-                        "name": df["name"][i],
-                        "class": df["class"][i],
-                    },
-                }
-
-                # Add optional properties if present
-                for key in [
-                    "state",
-                    "shard_id",
-                    "osm_id",
-                    "osm_type",
-                    "amenity",
-                    "shop",
-                    "cuisine",
-                    "brand",
-                    "opening_hours",
-                    "website",
-                    "phone",
-                    "operator",
-                ]:
-                    if key in df and df[key][i] not in (None, ""):
-                        feature["properties"][key] = df[key][i]
-
-                # Include any H3 columns if present (e.g. h3_r3..h3_r9)
-                for key in df.keys():
-                    if key.startswith("h3_r") and df[key][i] not in (None, ""):
-                        feature["properties"][key] = df[key][i]
-
-                f.write(json.dumps(feature) + "\n")
-                total_features += 1
-
-            if total_features % 100000 == 0:
-                print(f"    {total_features:,} features written...")
+    # Files from different pipeline versions may differ in optional columns
+    pois = conn.read_parquet([str(p) for p in parquet_files], union_by_name=True)
+    names = pois.columns
+    missing = [c for c in ["lon", "lat", "name", "class"] if c not in names]
+    if missing:
+        raise KeyError(
+            f"Missing required Parquet columns {missing}. "
+            f"Available: {sorted(names)}"
+        )
+    pois.create_view("pois")
 
-    print(f"Total features: {total_features:,}")
+    property_keys = ["name", "class"]
+    property_keys += [k for k in OPTIONAL_PROPERTIES if k in names]
+    property_keys += [k for k in names if k.startswith("h3_r")]
+    entries = ", ".join(
+        f"""{{'k': '{key}', 'v': "{key}"::VARCHAR}}""" for key in property_keys
+    )
+
+    # DuckDB renders each Feature; Python only joins lines per batch.
+    # Missing and empty values are left out of the properties.
+    reader = conn.execute(
+        f"""
+        SELECT to_json({{
+            'type': 'Feature',
+            'geometry': {{'type': 'Point', 'coordinates': [lon, lat]}},
+            'properties': map_from_entries(list_filter(
+                [{entries}],
+                e -> e.v IS NOT NULL AND e.v <> ''
+            ))
+        }})::VARCHAR as feature
+        FROM pois
+    """
+    ).fetch_record_batch(65536)
+
+    total_features = 0
+    next_log = PROGRESS_INTERVAL
+    for batch in reader:
+        lines = batch.column(0).to_pylist()
+        out.write(("\n".join(lines) + "\n").encode())
+        total_features += batch.num_rows
+        if total_features >= next_log:
+            print(f"    {total_features:,} features written...")
+            next_log += PROGRESS_INTERVAL
+
+    conn.close()
     return total_features
 
 
-def generate_pmtiles(geojson_path: Path, output_path: Path) -> None:
-    """Run tippecanoe to generate PMTiles."""
+def generate_pmtiles(parquet_files: list[Path], output_path: Path) -> int:
+    """Run tippecanoe on GeoJSON streamed from the Parquet files."""
     print("Generating PMTiles with tippecanoe...")
 
+    # No input file: tippecanoe reads GeoJSON features from stdin
     cmd = [
         "tippecanoe",
         "-o", str(output_path),
@@ -148,24 +171,52 @@ def generate_pmtiles(geojson_path: Path, output_path: Path) -> None:
         "--drop-densest-as-needed",  # Drop points at low zooms to avoid overcrowding
         "--extend-zooms-if-still-dropping",
         "--layer", "pois",
-        str(geojson_path),
     ]
 
     print(f"  Running: {' '.join(cmd)}")
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    # stderr goes to a file: tippecanoe's progress output would fill a pipe
+    # that nobody reads while we are busy writing its stdin
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=stderr)
+        total_features = None
+        try:
+            total_features = write_geojson_features(parquet_files, proc.stdin)
+        except BrokenPipeError:
+            pass  # tippecanoe exited early; its stderr says why
+        except BaseException:
+            # Don't leave tippecanoe running behind a failed feature write
+            proc.kill()
+            raise
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = proc.wait()
 
-    if result.returncode != 0:
-        print(f"tippecanoe failed: {result.stderr}")
-        sys.exit(1)
+        if total_features == 0:
+            print("ERROR: No features to process")
+            sys.exit(1)
+
+        if returncode != 0:
+            stderr.seek(0)
+            print(f"tippecanoe failed: {stderr.read().decode(errors='replace')}")
+            sys.exit(1)
 
+        if total_features is None:
+            print("ERROR: tippecanoe exited before reading all features")
+            sys.exit(1)
+
+    print(f"Total features: {total_features:,}")
     size_mb = output_path.stat().st_size / 1024 / 1024
     print(f"Generated {output_path} ({size_mb:.1f} MB)")
+    return total_features
 
 
 def upload_pmtiles(local_path: Path, bucket: str, key: str) -> str:
     """Upload PMTiles to S3."""
     print(f"Uploading to s3://{bucket}/{key}...")
-    s3 = boto3.client("s3")
+    s3 = get_s3_client()
 
     # Upload with correct content type for PMTiles
     s3.upload_file(
@@ -173,6 +224,7 @@ def upload_pmtiles(local_path: Path, bucket: str, key: str) -> str:
         bucket,
         key,
         ExtraArgs={"ContentType": "application/vnd.pmtiles"},
+        Config=TRANSFER_CONFIG,
     )
 
     return f"s3://{bucket}/{key}"
@@ -200,17 +252,9 @@ def main():
             print("ERROR: No Parquet files found in S3")
             sys.exit(1)
 
-        # Convert to GeoJSON
-        geojson_path = work_dir / "pois.geojson"
-        total_features = parquet_to_geojson(parquet_files, geojson_path)
-
-        if total_features == 0:
-            print("ERROR: No features to process")
-            sys.exit(1)
-
-        # Generate PMTiles
+        # Generate PMTiles, streaming GeoJSON into tippecanoe
         pmtiles_path = work_dir / PMTILES_OUTPUT
-        generate_pmtiles(geojson_path, pmtiles_path)
+        generate_pmtiles(parquet_files, pmtiles_path)
 
         # Upload to S3 (both run-specific and latest locations)
         s3_key = f"tiles/{PMTILES_OUTPUT}"